@@ -1,6 +1,7 @@
 # -*- coding:utf-8 -*-
 
 import json
+import base64
 import logging
 import inspect
 import functools
@@ -26,6 +27,48 @@ class Page(object):
 
     __repr__ = __str__
 
+# keyset分页用的游标, 是上一页最后一条记录(created_at, id)的json再base64
+# 对客户端来说只是一个不透明的字符串
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode('utf-8')).decode('ascii')
+
+# types: 游标里每个值的类型, 默认是(created_at, id)
+def decode_cursor(cursor, types=((int, float), str)):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    if not isinstance(values, list) or len(values) != len(types):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    for v, t in zip(values, types):
+        if not isinstance(v, t) or isinstance(v, bool):
+            raise APIValueError('cursor', 'Invalid cursor.')
+    return values
+
+class CursorPage(object):
+    ' page by cursor instead of offset, so deep pages cost the same as the first one. '
+    def __init__(self, cursor='', page_size=5):
+        self.page_size = page_size
+        self.cursor = cursor
+        self.after = decode_cursor(cursor) if cursor else None
+        # 多取一条, 用来判断是否还有下一页, 不需要count
+        self.limit = page_size + 1
+        self.next_cursor = None
+        self.has_next = False
+        self.has_previous = self.after is not None
+
+    def paginate(self, items, key=lambda item: (item.created_at, item.id)):
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        if self.has_next:
+            self.next_cursor = encode_cursor(key(items[-1]))
+        return items
+
+    def __str__(self):
+        return 'cursor: %s, page_size: %s, next_cursor: %s' % (self.cursor, self.page_size, self.next_cursor)
+
+    __repr__ = __str__
+
 class APIError(Exception):
     def __init__(self, error, data='', message=''):
         super(APIError, self).__init__(message)
@@ -2,14 +2,17 @@
 
 import logging; logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, re, json, time, hashlib
 from datetime import datetime
+from email.utils import formatdate
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
 import orm
 from coroweb import add_routes, add_static
 from config import configs
+from cache import Namespace
+from models import Blog, Comment
 from handlers import cookie2user, COOKIE_NAME
 
 def index(request):
@@ -42,10 +45,14 @@ middleware是一种拦截器，一个URL在被某个函数处理前，可以经
 一个middleware可以改变URL的输入、输出，甚至可以决定不继续处理而直接返回。
 middleware的用处就在于把通用的功能从每个URL处理函数中拿出来，集中放到一个地方。
 '''
+# 本进程处理过的请求数, server.py的worker定期上报给主进程
+request_stats = dict(requests=0, started_at=time.time())
+
 @asyncio.coroutine
 def logger_factory(app, handler):
     @asyncio.coroutine
     def logger(request):
+        request_stats['requests'] += 1
         logging.info('Request: %s %s' % (request.method, request.path))
         return (yield from handler(request))
     return logger
@@ -64,6 +71,98 @@ def data_factory(app, handler):
         return (yield from handler(request))
     return parse_data
     
+# 整页缓存: 没有登录cookie的GET请求, 首页和日志页对所有人都一样, 直接返回缓存的响应
+# key里带着版本号, 日志有写操作时所有页面失效, 评论有写操作时只有该日志的页面失效
+PAGE_CACHE_TTL = 300
+# 只有models.next_id()格式的日志id才走整页缓存, 随便编的id不会留下版本计数器
+PAGE_CACHE_PATHS = re.compile(r'^/(blog/(?P<id>\d{15}[0-9a-f]{32}000))?$')
+_page_cache = Namespace('page')
+
+@asyncio.coroutine
+def _page_key(request, m):
+    ' None if a version is unavailable, the page must not be cached then. '
+    versions = [(yield from _page_cache.version('all'))]
+    if m.group('id'):
+        versions.append((yield from _page_cache.version('blog:%s' % m.group('id'))))
+    if None in versions:
+        return None
+    return '%s:%s' % ('.'.join(map(str, versions)), request.path_qs)
+
+@orm.add_listener
+@asyncio.coroutine
+def _purge_pages(models, action):
+    if isinstance(models[0], Blog):
+        yield from _page_cache.bump('all')
+    elif isinstance(models[0], Comment):
+        for blog_id in set(m.blog_id for m in models):
+            yield from _page_cache.bump('blog:%s' % blog_id)
+
+def _page_response(request, page, hit):
+    headers = {'ETag': page['etag'], 'Last-Modified': formatdate(page['last_modified'], usegmt=True),
+               'Cache-Control': 'no-cache', 'X-Page-Cache': 'HIT' if hit else 'MISS'}
+    ims = request.if_modified_since
+    if request.headers.get('If-None-Match') == page['etag'] or \
+            (ims is not None and 'If-None-Match' not in request.headers and ims.timestamp() >= int(page['last_modified'])):
+        return web.Response(status=304, headers=headers)
+    headers['Content-Type'] = page['content_type']
+    return web.Response(body=page['body'], headers=headers)
+
+@asyncio.coroutine
+def page_cache_factory(app, handler):
+    @asyncio.coroutine
+    def page_cache(request):
+        m = PAGE_CACHE_PATHS.match(request.path)
+        if request.method != 'GET' or m is None or request.cookies.get(COOKIE_NAME):
+            return (yield from handler(request))
+        key = yield from _page_key(request, m)
+        if key is None:
+            return (yield from handler(request))
+        page = yield from _page_cache.get(key)
+        if page is not None:
+            return _page_response(request, page, True)
+        # 要缓存整个body, 不能流式输出; 要缓存的页面从主库读
+        request.__page_cache__ = True
+        orm.read_primary()
+        r = yield from handler(request)
+        # 只缓存模板渲染出来的页面
+        if not request.__page_cache__ or not isinstance(r, web.Response) or r.status != 200 or not isinstance(r.body, bytes) \
+                or r.content_type != 'text/html':
+            return r
+        page = dict(body=r.body, content_type=r.headers.get('Content-Type', 'text/html;charset=utf-8'), last_modified=time.time(),
+                    etag='"%s"' % hashlib.sha1(r.body).hexdigest()[:20])
+        yield from _page_cache.set(key, page, PAGE_CACHE_TTL, len(r.body))
+        return _page_response(request, page, False)
+    return page_cache
+
+# orm.Record之类用__slots__的对象没有__dict__, 用to_dict()序列化
+def json_default(o):
+    if hasattr(o, 'to_dict'):
+        return o.to_dict()
+    return o.__dict__
+
+# handler返回的dict中'__stream__'为True时, 模板边渲染边发送, 不等整个页面渲染完
+STREAM_CHUNK_SIZE = 8192
+
+@asyncio.coroutine
+def stream_template(request, template, r):
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html;charset=utf-8'
+    yield from resp.prepare(request)
+    buf = []
+    size = 0
+    for s in template.generate(**r):
+        buf.append(s)
+        size = size + len(s)
+        if size >= STREAM_CHUNK_SIZE:
+            resp.write(''.join(buf).encode('utf-8'))
+            yield from resp.drain()
+            buf = []
+            size = 0
+    if buf:
+        resp.write(''.join(buf).encode('utf-8'))
+    yield from resp.write_eof()
+    return resp
+
 @asyncio.coroutine
 def response_factory(app, handler):
     @asyncio.coroutine
@@ -85,12 +184,17 @@ def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
                 r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                if r.get('__nocache__'):
+                    request.__page_cache__ = False
+                t = app['__templating__'].get_template(template)
+                if r.get('__stream__') and not getattr(request, '__page_cache__', False):
+                    return (yield from stream_template(request, t, r))
+                resp = web.Response(body=t.render(**r).encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:
@@ -135,17 +239,30 @@ def date_filter(ts):
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
     
 @asyncio.coroutine
-def init(loop):
-    yield from orm.create_pool(loop=loop, user=configs.db.user, pwd=configs.db.password, db=configs.db.db)
-    app = web.Application(loop=loop, middlewares=[logger_factory, data_factory, response_factory, auth_factory])
+def make_app(loop):
+    yield from orm.create_pool(loop=loop, user=configs.db.user, pwd=configs.db.password, db=configs.db.db,
+                               replicas=configs.db.get('replicas', ()), balance=configs.db.get('balance', 'round-robin'),
+                               slow_query_threshold=configs.db.get('slow_query_threshold', orm.SLOW_QUERY_THRESHOLD))
+    app = web.Application(loop=loop, middlewares=[logger_factory, page_cache_factory, data_factory, response_factory, auth_factory])
     init_jinja2(app, filters=dict(datetime=date_filter))
     add_routes(app, 'handlers')
     add_static(app)
     #app.router.add_route('GET', '/', index)
-    srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
+    return app
+
+# sock: 已经绑定好的socket, 多进程部署时由server.py传入
+@asyncio.coroutine
+def init(loop, sock=None):
+    app = yield from make_app(loop)
+    if sock is not None:
+        srv = yield from loop.create_server(app.make_handler(), sock=sock)
+    else:
+        srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
     logging.info('server starting...')
     return srv
-    
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+
+# 单进程运行, 开发时用; 生产环境用 python3 server.py 启动多个worker
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(init(loop))
+    loop.run_forever()
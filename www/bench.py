@@ -0,0 +1,137 @@
+# -*- coding:utf-8 -*-
+
+'''
+benchmarks
+
+    python3 bench.py models [N]              Model和Record的内存占用, 属性访问速度
+    python3 bench.py markdown [PATH ...]     markdown2新旧两种占位符的转换时间
+                                             PATH是.md文件或目录, 不给时用数据库里的全部日志
+    python3 bench.py profile [PATH ...]      markdown2各阶段和各extra的耗时, 语料同上
+'''
+
+import os
+import sys
+import time
+import timeit
+import asyncio
+import hashlib
+import tracemalloc
+
+import markdown2
+import models
+import orm
+from config import configs
+
+def bench_models(n=10000):
+    rows = []
+    for i in range(n):
+        rows.append(dict(id=models.next_id(), user_id='u%s' % i, user_name='user', user_image='about:blank',
+                         name='blog %s' % i, summary='summary', content='content ' * 50,
+                         html_content=None, render_version=None, created_at=time.time()))
+    print('%s rows of Blog' % n)
+    for name, cls in (('Model', models.Blog), ('Record', models.Blog.__record__)):
+        tracemalloc.start()
+        objs = [cls(**r) for r in rows]
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        t = timeit.timeit(lambda: [(o.id, o.name, o.created_at) for o in objs], number=10)
+        print('%-8s memory: %8.1f KB   attribute access: %.3f us' % (name, size / 1024, t / (10 * 3 * n) * 1e6))
+
+def load_corpus(paths):
+    texts = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(('.md', '.markdown', '.txt'))]
+        else:
+            files = [path]
+        for f in files:
+            with open(f, encoding='utf-8') as fp:
+                texts.append(fp.read())
+    if paths:
+        return texts
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(orm.create_pool(loop=loop, user=configs.db.user, pwd=configs.db.password, db=configs.db.db))
+
+    async def contents():
+        return [b.content async for b in models.Blog.iterate(fields=('id', 'content'))]
+    return loop.run_until_complete(contents())
+
+# 改用计数器占位符之前的做法: 对文本算md5, 还原时对每个占位符做一次replace
+def _legacy_hash_text(s, salt=b'1234'):
+    return 'md5-' + hashlib.md5(salt + s.encode('utf-8')).hexdigest()
+
+def _legacy_encode_code(self, text):
+    for before, after in (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;')):
+        text = text.replace(before, after)
+    hashed = _legacy_hash_text(text)
+    self._escape_table[text] = hashed
+    return hashed
+
+def _legacy_unescape_special_chars(self, text):
+    for ch, hash in list(self._escape_table.items()):
+        text = text.replace(hash, ch)
+    return text
+
+def _legacy_encode_backslash_escapes(self, text):
+    for ch, escape in list(self._escape_table.items()):
+        text = text.replace('\\' + ch, escape)
+    return text
+
+def _legacy_unhash_html_spans(self, text):
+    for key, sanitized in list(self.html_spans.items()):
+        text = text.replace(key, sanitized)
+    return text
+
+def _convert_all(texts):
+    pool = markdown2.converter_pool()
+    for t in texts:
+        pool.convert(t)
+
+def bench_markdown(paths, number=5):
+    texts = load_corpus(paths)
+    print('%s posts, %s KB' % (len(texts), sum(len(t) for t in texts) // 1024))
+    current = timeit.timeit(lambda: _convert_all(texts), number=number) / number
+    legacy_methods = dict(_encode_code=_legacy_encode_code,
+                          _encode_backslash_escapes=_legacy_encode_backslash_escapes,
+                          _unescape_special_chars=_legacy_unescape_special_chars,
+                          _unhash_html_spans=_legacy_unhash_html_spans)
+    saved_hash, saved = markdown2._hash_text, dict((k, getattr(markdown2.Markdown, k)) for k in legacy_methods)
+    markdown2._hash_text = _legacy_hash_text
+    for k, f in legacy_methods.items():
+        setattr(markdown2.Markdown, k, f)
+    try:
+        legacy = timeit.timeit(lambda: _convert_all(texts), number=number) / number
+    finally:
+        markdown2._hash_text = saved_hash
+        for k, f in saved.items():
+            setattr(markdown2.Markdown, k, f)
+    print('md5 placeholders:     %8.1f ms' % (legacy * 1000))
+    print('counter placeholders: %8.1f ms   (%.1f%% faster)' % (current * 1000, (legacy - current) / legacy * 100))
+
+def bench_profile(paths):
+    import render
+    texts = load_corpus(paths)
+    markdown2.reset_profile_stats()
+    pool = markdown2.converter_pool(extras=render.MARKDOWN_EXTRAS, profile=True)
+    for t in texts:
+        pool.convert(t)
+    st = markdown2.profile_stats()
+    print('%s posts, %.1f ms' % (st['conversions'], st['time'] * 1000))
+    print('%-30s %8s %10s %10s %6s' % ('stage', 'calls', 'time ms', 'self ms', 'self%'))
+    for name, s in sorted(st['stages'].items(), key=lambda kv: -kv[1]['self_time']):
+        print('%-30s %8d %10.1f %10.1f %5.1f%%' % (name, s['calls'], s['time'] * 1000, s['self_time'] * 1000,
+                                                  s['self_time'] / st['time'] * 100))
+    for name, t in sorted(st['extras'].items(), key=lambda kv: -kv[1]):
+        print('extra %-24s %30.1f' % (name, t * 1000))
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in ('models', 'markdown', 'profile'):
+        print(__doc__)
+        exit(0)
+    if argv[0] == 'models':
+        bench_models(*[int(a) for a in argv[1:2]])
+    if argv[0] == 'markdown':
+        bench_markdown(argv[1:])
+    if argv[0] == 'profile':
+        bench_profile(argv[1:])
@@ -0,0 +1,790 @@
+# -*- coding:utf-8 -*-
+
+'''
+caches
+
+LRUCache按字节数限制大小, 超出时淘汰最久未使用的条目, 条目可以带过期时间
+DiskCache把条目存成文件, 作为LRUCache之后的第二层, 目录按总字节数(和可选的max_age)清理, 先删最久没用过的
+
+查询缓存, 会话缓存, 渲染缓存都通过Namespace使用同一个后端, 后端由configs.cache.backend选择:
+    memory  进程内的LRUCache, 进程重启就没了, 也不在worker之间共享(默认), server.py多worker时不能用
+    mmap    映射到共享文件的定长哈希表, 同一台机器上的所有进程共享, 重启后仍在
+            必须配置path, 放在只有运行网站的用户能写的目录里; 文件必须属于当前用户且权限为0600
+    redis   asyncio的redis协议客户端, 开发测试时可以用 python3 cache.py redis-server 起一个本地的假服务器
+后端的get/set/delete/counter/incr都是协程
+mmap和redis是共享存储, 里面的值用json编码, 不用pickle: 能改写这些数据的人不能借此在worker里执行代码
+
+counter用到了SET的NX和GET一起用, 需要redis 7.0以上
+'''
+
+import os
+import sys
+import json
+import stat
+import time
+import mmap
+import fcntl
+import base64
+import struct
+import asyncio
+import hashlib
+import logging
+import threading
+import socketserver
+
+from collections import OrderedDict, deque
+
+from config import configs
+
+def sizeof(value):
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return sys.getsizeof(value)
+
+class LRUCache(object):
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                item = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if item[2] is not None and item[2] <= time.time():
+                self.bytes -= item[1]
+                self.misses += 1
+                return default
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None, size=None):
+        if size is None:
+            size = sizeof(value)
+        if size > self.max_bytes:
+            return
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size, expires)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, item = self._data.popitem(last=False)
+                self.bytes -= item[1]
+
+    def delete(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self.bytes -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return dict(entries=len(self._data), bytes=self.bytes, max_bytes=self.max_bytes,
+                    hits=self.hits, misses=self.misses)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+class DiskCache(object):
+    ' str values stored as utf-8 files, one file per key, kept under max_bytes and max_age. '
+    # 每写入这么多次检查一遍目录
+    SWEEP_EVERY = 100
+
+    def __init__(self, path, max_bytes=256*1024*1024, max_age=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # 第一次写入时就检查一遍, 上次运行留下的文件也算在内
+        self._writes = self.SWEEP_EVERY - 1
+        # 上次清理后目录的大小加上本进程写入的字节数, 超过max_bytes也要清理
+        self._bytes = 0
+        self._sweeping = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        # 两级目录, 避免单个目录下文件过多
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key, default=None):
+        fn = self._file(key)
+        try:
+            with open(fn, 'rb') as f:
+                value = f.read().decode('utf-8')
+        except OSError:
+            return default
+        # mtime当作最近使用时间, 清理时先删最久没用过的
+        try:
+            os.utime(fn)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        fn = self._file(key)
+        tmp = '%s.%s.tmp' % (fn, os.getpid())
+        data = value.encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            # rename是原子的, 其他进程不会读到写了一半的文件
+            os.replace(tmp, fn)
+        except OSError as e:
+            logging.warning('disk cache write failed: %s' % e)
+        self._writes += 1
+        self._bytes += len(data)
+        if self._writes >= self.SWEEP_EVERY or self._bytes > self.max_bytes:
+            self.sweep()
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def sweep(self):
+        ' remove expired files, then the least recently used ones until the directory is below max_bytes. '
+        # 在执行器的多个线程里调用, 同时只清理一次; 多个进程同时清理时删除失败的忽略即可
+        if not self._sweeping.acquire(blocking=False):
+            return
+        try:
+            self._writes = 0
+            now = time.time()
+            files = []
+            total = 0
+            for fn, st in self._scan():
+                # 写了一半进程就退出了的临时文件
+                if fn.endswith('.tmp'):
+                    if now - st.st_mtime > 3600:
+                        self._remove(fn)
+                    continue
+                if self.max_age is not None and now - st.st_mtime > self.max_age:
+                    self._remove(fn)
+                    continue
+                files.append((st.st_mtime, st.st_size, fn))
+                total = total + st.st_size
+            if total > self.max_bytes:
+                total = self._evict(files, total)
+            self._bytes = total
+        finally:
+            self._sweeping.release()
+
+    def _evict(self, files, total):
+        # 删到九成, 免得下一次写入后马上又要清理
+        files.sort()
+        for mtime, size, fn in files:
+            if total <= self.max_bytes * 0.9:
+                break
+            self._remove(fn)
+            total = total - size
+        return total
+
+    def _scan(self):
+        try:
+            dirs = [d.path for d in os.scandir(self.path) if d.is_dir(follow_symlinks=False)]
+        except OSError:
+            return
+        for d in dirs:
+            try:
+                entries = list(os.scandir(d))
+            except OSError:
+                continue
+            for e in entries:
+                try:
+                    if e.is_file(follow_symlinks=False):
+                        yield e.path, e.stat(follow_symlinks=False)
+                except OSError:
+                    pass
+
+    def _remove(self, fn):
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+# 共享存储的编码: json, bytes和tuple加上标记, 读出来还是bytes和tuple
+# json表示不了的值(datetime, Decimal之类)不缓存
+def _tag(o):
+    if isinstance(o, bytes):
+        return {'__bytes__': base64.b64encode(o).decode('ascii')}
+    if isinstance(o, tuple):
+        return {'__tuple__': [_tag(v) for v in o]}
+    if isinstance(o, list):
+        return [_tag(v) for v in o]
+    if isinstance(o, dict):
+        return {k: _tag(v) for k, v in o.items()}
+    return o
+
+def _untag(d):
+    if len(d) == 1:
+        if '__bytes__' in d:
+            return base64.b64decode(d['__bytes__'])
+        if '__tuple__' in d:
+            return tuple(d['__tuple__'])
+    return d
+
+def encode(value):
+    ' value => bytes, raise TypeError if json cannot represent it. '
+    return json.dumps(_tag(value), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def decode(data):
+    ' bytes => value, None if the data is not valid. '
+    try:
+        return json.loads(data.decode('utf-8'), object_hook=_untag)
+    except (ValueError, TypeError) as e:
+        logging.warning('bad cache entry: %s' % e)
+        return None
+
+def _encode_or_none(value):
+    try:
+        return encode(value)
+    except (TypeError, ValueError) as e:
+        logging.debug('value not cached: %s' % e)
+        return None
+
+# 计数器(用作缓存的版本号)丢失后从当前时间重新开始, 不会回到以前用过的值
+# 所以计数器可以被淘汰, 也都带着过期时间, 很久不用的版本号不会一直占着空间
+COUNTER_TTL = 86400
+
+def _counter_start():
+    return int(time.time() * 1000000)
+
+class MemoryBackend(object):
+    ' per-process backend, values are kept as python objects. '
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_counters=100000):
+        self._lru = LRUCache(max_bytes)
+        # 计数器单独存放, 不会被缓存的条目挤掉; 每个计数器按1计, 最多max_counters个
+        self._counters = LRUCache(max_counters)
+
+    @asyncio.coroutine
+    def get(self, key):
+        return self._lru.get(key)
+
+    @asyncio.coroutine
+    def set(self, key, value, ttl=None, size=None):
+        self._lru.set(key, value, ttl, size)
+
+    @asyncio.coroutine
+    def delete(self, key):
+        self._lru.delete(key)
+        self._counters.delete(key)
+
+    def _counter(self, key):
+        n = self._counters.get(key)
+        if n is None:
+            n = _counter_start()
+            self._counters.set(key, n, COUNTER_TTL, 1)
+        return n
+
+    @asyncio.coroutine
+    def counter(self, key):
+        return self._counter(key)
+
+    @asyncio.coroutine
+    def incr(self, key):
+        n = self._counter(key) + 1
+        self._counters.set(key, n, COUNTER_TTL, 1)
+        return n
+
+    def stats(self):
+        return dict(self._lru.stats(), backend='memory', counters=len(self._counters))
+
+class MmapBackend(object):
+    ' fixed-size hash table in a shared file, an entry spans up to max_span slots, a new key overwrites colliding ones. '
+    # slot: key的hash, 过期时间(0表示不过期), key长度, value总长度, 第几段, 共几段, 然后是key和编码后的value
+    # 第一个slot放不下的value接着写进后面的slot, 这些slot的header里key长度为0, value长度是本段的长度
+    # 读的时候逐个核对hash和段号, 有一段被别的key覆盖了就当作没有
+    _header = struct.Struct('<QdIIHH')
+
+    def __init__(self, path, slots=4096, slot_size=4096, max_span=64):
+        if slot_size <= self._header.size:
+            raise ValueError('Invalid mmap slot size: %s' % slot_size)
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_span = min(max_span, slots)
+        # 超过max_span个slot的value存不下, 记个数
+        self.too_large = 0
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        # fork之后重新打开, flock的锁属于打开的文件, 不能和父进程共用
+        if self._pid == os.getpid():
+            return self._map
+        size = self.slots * self.slot_size
+        # 不跟随符号链接; 别人预先建好的文件不用
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+            os.fchmod(fd, 0o600)
+        except FileExistsError:
+            fd = os.open(self.path, os.O_RDWR | os.O_NOFOLLOW)
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o600:
+            os.close(fd)
+            raise ValueError('Unsafe cache file %s: must be a regular file owned by uid %s with mode 0600' % (self.path, os.getuid()))
+        if st.st_size < size:
+            os.ftruncate(fd, size)
+        self._fd = fd
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+        return self._map
+
+    def _slot(self, key):
+        k = key.encode('utf-8')
+        h = int.from_bytes(hashlib.sha1(k).digest()[:8], 'little')
+        return k, h, (h % self.slots) * self.slot_size
+
+    def _offset(self, offset, i):
+        ' offset of the i-th slot after the one at offset, wrapping around. '
+        return (offset // self.slot_size + i) % self.slots * self.slot_size
+
+    def _read(self, m, k, h, offset):
+        kh, expires, klen, vlen, part, parts = self._header.unpack_from(m, offset)
+        start = offset + self._header.size
+        if kh != h or part != 0 or klen != len(k) or m[start:start+klen] != k:
+            return None
+        if expires and expires <= time.time():
+            return None
+        start = start + klen
+        chunks = [m[start:start+min(vlen, offset + self.slot_size - start)]]
+        for i in range(1, parts):
+            o = self._offset(offset, i)
+            ch, _, _, clen, cpart, _ = self._header.unpack_from(m, o)
+            if ch != h or cpart != i:
+                return None
+            chunks.append(m[o+self._header.size:o+self._header.size+clen])
+        data = b''.join(chunks)
+        return data if len(data) == vlen else None
+
+    def _write(self, m, k, h, offset, data, ttl):
+        size = self.slot_size - self._header.size
+        first = size - len(k)
+        parts = 1 + max(0, -(-(len(data) - first) // size))
+        if first < 0 or parts > self.max_span:
+            self.too_large += 1
+            return False
+        expires = time.time() + ttl if ttl else 0
+        self._header.pack_into(m, offset, h, expires, len(k), len(data), 0, parts)
+        start = offset + self._header.size
+        m[start:start+len(k)] = k
+        m[start+len(k):start+len(k)+min(len(data), first)] = data[:first]
+        for i in range(1, parts):
+            o = self._offset(offset, i)
+            chunk = data[first+(i-1)*size:first+i*size]
+            self._header.pack_into(m, o, h, expires, 0, len(chunk), i, parts)
+            m[o+self._header.size:o+self._header.size+len(chunk)] = chunk
+        return True
+
+    @asyncio.coroutine
+    def get(self, key):
+        m = self._open()
+        k, h, offset = self._slot(key)
+        fcntl.flock(self._fd, fcntl.LOCK_SH)
+        try:
+            data = self._read(m, k, h, offset)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return decode(data) if data is not None else None
+
+    @asyncio.coroutine
+    def set(self, key, value, ttl=None, size=None):
+        m = self._open()
+        k, h, offset = self._slot(key)
+        data = _encode_or_none(value)
+        if data is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            self._write(m, k, h, offset, data, ttl)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @asyncio.coroutine
+    def delete(self, key):
+        m = self._open()
+        k, h, offset = self._slot(key)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if self._read(m, k, h, offset) is not None:
+                self._header.pack_into(m, offset, 0, 0, 0, 0, 0, 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _add(self, key, delta):
+        m = self._open()
+        k, h, offset = self._slot(key)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            data = self._read(m, k, h, offset)
+            n = decode(data) if data is not None else None
+            n = n + delta if isinstance(n, int) else _counter_start()
+            self._write(m, k, h, offset, encode(n), COUNTER_TTL)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return n
+
+    @asyncio.coroutine
+    def counter(self, key):
+        return self._add(key, 0)
+
+    @asyncio.coroutine
+    def incr(self, key):
+        return self._add(key, 1)
+
+    def stats(self):
+        return dict(backend='mmap', path=self.path, slots=self.slots, slot_size=self.slot_size,
+                    max_span=self.max_span, too_large=self.too_large)
+
+class RedisError(Exception):
+    pass
+
+class RedisBackend(object):
+    ' minimal asyncio redis client; errors are logged and treated as cache misses. '
+    # 所有命令共用一个连接, 发出去的命令按顺序排队等回复, 不用等上一条回复就能发下一条
+    def __init__(self, host='127.0.0.1', port=6379, db=0, timeout=1.0, prefix='blog:'):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.timeout = timeout
+        self.prefix = prefix
+        self._pid = None
+        self._writer = None
+        self._waiters = None
+        self._reader_task = None
+        self._lock = None
+
+    @asyncio.coroutine
+    def _connect(self):
+        if self._pid != os.getpid():
+            # fork之后不能用父进程的连接, 每个worker有自己的事件循环
+            self._writer = None
+            self._lock = asyncio.Lock()
+            self._pid = os.getpid()
+        if self._writer is not None:
+            return
+        yield from self._lock.acquire()
+        try:
+            if self._writer is not None:
+                return
+            reader, writer = yield from asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+            self._writer = writer
+            self._waiters = deque()
+            self._reader_task = asyncio.ensure_future(self._read_replies(reader, writer, self._waiters))
+            if self.db:
+                r = yield from asyncio.wait_for(self._send([('SELECT', self.db)])[0], self.timeout)
+                if isinstance(r, RedisError):
+                    raise r
+        finally:
+            self._lock.release()
+
+    @asyncio.coroutine
+    def _read_replies(self, reader, writer, waiters):
+        try:
+            while True:
+                reply = yield from _read_reply_async(reader)
+                f = waiters.popleft()
+                if not f.done():
+                    f.set_result(reply)
+        except (OSError, EOFError, IndexError, ValueError, RedisError) as e:
+            if waiters:
+                logging.warning('redis connection lost: %s' % e)
+        finally:
+            while waiters:
+                f = waiters.popleft()
+                if not f.done():
+                    f.set_exception(RedisError('connection closed'))
+            if self._writer is writer:
+                self._close()
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader_task.cancel()
+        self._writer = None
+
+    def _send(self, commands):
+        ' write the commands at once, return a future for each reply. '
+        loop = asyncio.get_event_loop()
+        futures = []
+        parts = []
+        for args in commands:
+            parts.append(b'*%d\r\n' % len(args))
+            for a in args:
+                if not isinstance(a, bytes):
+                    a = str(a).encode('utf-8')
+                parts.append(b'$%d\r\n%s\r\n' % (len(a), a))
+            f = loop.create_future()
+            self._waiters.append(f)
+            futures.append(f)
+        self._writer.write(b''.join(parts))
+        return futures
+
+    @asyncio.coroutine
+    def pipeline(self, *commands):
+        ' send the commands in one round trip and return their replies, a RedisError for each failed one. '
+        try:
+            yield from self._connect()
+            replies = yield from asyncio.wait_for(asyncio.gather(*self._send(commands)), self.timeout)
+        except (OSError, RedisError, asyncio.TimeoutError) as e:
+            logging.warning('redis %s failed: %s' % (' '.join(args[0] for args in commands), e))
+            self._close()
+            return [RedisError(str(e))] * len(commands)
+        for args, r in zip(commands, replies):
+            if isinstance(r, RedisError):
+                logging.warning('redis %s failed: %s' % (args[0], r))
+        return replies
+
+    @asyncio.coroutine
+    def command(self, *args):
+        r = (yield from self.pipeline(args))[0]
+        return None if isinstance(r, RedisError) else r
+
+    @asyncio.coroutine
+    def get(self, key):
+        data = yield from self.command('GET', self.prefix + key)
+        return decode(data) if data is not None else None
+
+    @asyncio.coroutine
+    def set(self, key, value, ttl=None, size=None):
+        data = _encode_or_none(value)
+        if data is None:
+            return
+        if ttl:
+            yield from self.command('SET', self.prefix + key, data, 'PX', max(1, int(ttl * 1000)))
+        else:
+            yield from self.command('SET', self.prefix + key, data)
+
+    @asyncio.coroutine
+    def delete(self, key):
+        yield from self.command('DEL', self.prefix + key)
+
+    # 计数器以整数形式保存, 用INCR递增, 新建时带上过期时间, INCR不改变过期时间
+    # 读取只用一条命令: 不存在时设为起始值, GET返回原来的值
+    @asyncio.coroutine
+    def counter(self, key):
+        start = _counter_start()
+        r = (yield from self.pipeline(('SET', self.prefix + key, start, 'NX', 'GET', 'PX', COUNTER_TTL * 1000)))[0]
+        if isinstance(r, RedisError):
+            return None
+        return int(r) if r is not None else start
+
+    @asyncio.coroutine
+    def incr(self, key):
+        r = yield from self.pipeline(('SET', self.prefix + key, _counter_start(), 'NX', 'PX', COUNTER_TTL * 1000),
+                                     ('INCR', self.prefix + key))
+        return None if isinstance(r[1], RedisError) else r[1]
+
+    def stats(self):
+        return dict(backend='redis', host=self.host, port=self.port, db=self.db)
+
+def _read_reply(f):
+    line = f.readline()
+    if not line.endswith(b'\r\n'):
+        raise RedisError('connection closed')
+    t, body = line[:1], line[1:-2]
+    if t == b'+':
+        return body.decode('utf-8')
+    if t == b'-':
+        raise RedisError(body.decode('utf-8'))
+    if t == b':':
+        return int(body)
+    if t == b'$':
+        n = int(body)
+        if n < 0:
+            return None
+        data = f.read(n + 2)
+        return data[:-2]
+    if t == b'*':
+        n = int(body)
+        if n < 0:
+            return None
+        return [_read_reply(f) for i in range(n)]
+    raise RedisError('bad reply: %r' % line)
+
+# 客户端用的版本, 错误回复作为RedisError对象返回, 不影响同一连接上的其他命令
+@asyncio.coroutine
+def _read_reply_async(reader):
+    line = yield from reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise RedisError('connection closed')
+    t, body = line[:1], line[1:-2]
+    if t == b'+':
+        return body.decode('utf-8')
+    if t == b'-':
+        return RedisError(body.decode('utf-8'))
+    if t == b':':
+        return int(body)
+    if t == b'$':
+        n = int(body)
+        if n < 0:
+            return None
+        data = yield from reader.readexactly(n + 2)
+        return data[:-2]
+    if t == b'*':
+        n = int(body)
+        if n < 0:
+            return None
+        items = []
+        for i in range(n):
+            items.append((yield from _read_reply_async(reader)))
+        return items
+    raise RedisError('bad reply: %r' % line)
+
+# 本地开发和测试用的redis替身, 只实现了RedisBackend用到的几个命令
+class LocalRedisServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 6379)):
+        self.data = {}
+        self.lock = threading.Lock()
+        super(LocalRedisServer, self).__init__(address, _LocalRedisHandler)
+
+    def call(self, args):
+        cmd = args[0].decode('utf-8').upper()
+        with self.lock:
+            if cmd == 'PING':
+                return '+PONG'
+            if cmd in ('SELECT', 'FLUSHDB'):
+                if cmd == 'FLUSHDB':
+                    self.data.clear()
+                return '+OK'
+            key = args[1]
+            value, expires = self.data.get(key, (None, None))
+            if expires is not None and expires <= time.time():
+                del self.data[key]
+                value = None
+            if cmd == 'GET':
+                return value
+            if cmd == 'DEL':
+                return 1 if self.data.pop(key, None) is not None else 0
+            if cmd == 'INCR':
+                n = int(value or 0) + 1
+                self.data[key] = (str(n).encode('utf-8'), expires)
+                return n
+            if cmd == 'SET':
+                opts = [a.decode('utf-8').upper() for a in args[3:]]
+                if 'NX' in opts and value is not None:
+                    return value if 'GET' in opts else None
+                ttl = None
+                if 'PX' in opts:
+                    ttl = int(opts[opts.index('PX') + 1]) / 1000.0
+                elif 'EX' in opts:
+                    ttl = int(opts[opts.index('EX') + 1])
+                self.data[key] = (args[2], time.time() + ttl if ttl else None)
+                return value if 'GET' in opts else '+OK'
+        return RedisError("unknown command '%s'" % cmd)
+
+class _LocalRedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                args = _read_reply(self.rfile)
+            except (RedisError, ValueError):
+                return
+            r = self.server.call(args)
+            if isinstance(r, RedisError):
+                out = b'-ERR ' + str(r).encode('utf-8') + b'\r\n'
+            elif r is None:
+                out = b'$-1\r\n'
+            elif isinstance(r, int):
+                out = b':%d\r\n' % r
+            elif isinstance(r, str):
+                out = r.encode('utf-8') + b'\r\n'
+            else:
+                out = b'$%d\r\n%s\r\n' % (len(r), r)
+            self.wfile.write(out)
+
+def create_backend(options):
+    kind = options.get('backend', 'memory')
+    if kind == 'memory':
+        return MemoryBackend(options.get('max_bytes', 64 * 1024 * 1024), options.get('max_counters', 100000))
+    if kind == 'mmap':
+        # 不提供默认路径: /tmp之类公共目录里的文件可能被别人抢先建好
+        if not options.get('path'):
+            raise ValueError('configs.cache.path is required for the mmap backend')
+        return MmapBackend(options['path'],
+                           options.get('slots', 4096), options.get('slot_size', 4096), options.get('max_span', 64))
+    if kind == 'redis':
+        return RedisBackend(options.get('host', '127.0.0.1'), options.get('port', 6379),
+                            options.get('db', 0), options.get('timeout', 1.0), options.get('prefix', 'blog:'))
+    raise ValueError('Invalid cache backend: %s' % kind)
+
+_backend = None
+
+def backend():
+    ' the backend chosen in configs.cache, created on first use. '
+    global _backend
+    if _backend is None:
+        _backend = create_backend(configs.get('cache', {}))
+    return _backend
+
+class Namespace(object):
+    ' a view of the shared backend with its own key prefix and hit counters. '
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return '%s:%s' % (self.name, key)
+
+    @asyncio.coroutine
+    def get(self, key):
+        value = yield from backend().get(self._key(key))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    @asyncio.coroutine
+    def set(self, key, value, ttl=None, size=None):
+        yield from backend().set(self._key(key), value, ttl, size)
+
+    @asyncio.coroutine
+    def delete(self, key):
+        yield from backend().delete(self._key(key))
+
+    # 版本号: 放进缓存key里, 递增之后旧的条目就不会再命中, 用来批量失效
+    # 后端出错时返回None, 调用方这时既不能读也不能写缓存
+    @asyncio.coroutine
+    def version(self, name):
+        return (yield from backend().counter(self._key('version:%s' % name)))
+
+    @asyncio.coroutine
+    def bump(self, name):
+        return (yield from backend().incr(self._key('version:%s' % name)))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / total if total else 0.0,
+                    backend=backend().stats())
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if not argv or argv[0] != 'redis-server':
+        print('Usage: python3 cache.py redis-server [port]')
+        exit(0)
+    logging.basicConfig(level=logging.INFO)
+    server = LocalRedisServer(('127.0.0.1', int(argv[1]) if len(argv) > 1 else 6379))
+    logging.info('local redis server at %s:%s' % server.server_address)
+    server.serve_forever()
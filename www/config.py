@@ -28,6 +28,10 @@ def merge(default, override):
                 r[k] = override[k]
         else:
             r[k] = v
+    # 只在override里出现的配置项也保留
+    for k, v in override.items():
+        if k not in default:
+            r[k] = v
     return r
     
 # 程序员的价值观
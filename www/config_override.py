@@ -6,4 +6,10 @@ override configurations
 
 configs = {
     'db':{'host':'localhost'},
+    # 缓存后端: memory, mmap(path, slots, slot_size, max_span), redis(host, port, db)
+    # 单进程运行(python3 app.py)用memory就行
+    # server.py起多个worker时不能用memory, 各worker的缓存不会一起失效, 要改成共享的后端, 例如
+    #     'cache':{'backend':'mmap', 'path':'/var/lib/blog/cache.mmap'}
+    # mmap的path必须在只有运行网站的用户能写的目录里, 不要放在/tmp
+    'cache':{'backend':'memory'},
 }
\ No newline at end of file
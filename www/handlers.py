@@ -20,14 +20,19 @@ import asyncio
 
 from aiohttp import web
 
-import markdown2
-from apis import APIError, APIValueError, APIResourceNotFoundError, APIPermissionError, Page
+import orm
+import render
+from cache import Namespace
+from apis import APIError, APIValueError, APIResourceNotFoundError, APIPermissionError, Page, CursorPage
 from coroweb import get, post
 from models import User, Comment, Blog, next_id
 from config import configs
 
 _EMAIL = re.compile(r'^[a-z0-9\-\.\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _SHA1 = re.compile(r'^[0-9a-f]{40}$')
+# models.next_id()生成的id: 15位毫秒时间戳 + 32位uuid hex + 000
+# cookie里格式不对的uid直接拒绝, 伪造的cookie不会在缓存里留下计数器
+_UID = re.compile(r'^\d{15}[0-9a-f]{32}000$')
 
 COOKIE_NAME = 'zider'
 _COOKIE_KEY = configs.session.secret
@@ -41,6 +46,27 @@ def user2cookie(user, max_age):
     L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
     return '-'.join(L)
     
+# 验证通过的cookie => user, 条目在cookie过期时失效
+# 这样带cookie的请求不用每次都查数据库和计算sha1
+# key里带着该用户的版本号, 多个worker共享同一个缓存后端时也能一起失效
+_session_cache = Namespace('session')
+
+@asyncio.coroutine
+def _session_key(uid, cookie_str):
+    ' None if the version is unavailable, the session must not be cached then. '
+    version = yield from _session_cache.version(uid)
+    if version is None:
+        return None
+    return '%s:%s' % (version, cookie_str)
+
+@orm.add_listener
+@asyncio.coroutine
+def _invalidate_sessions(models, action):
+    # 密码, admin等变化后, 该用户已缓存的会话都要重新验证; 新用户还没有会话
+    if isinstance(models[0], User) and action != 'save':
+        for uid in set(m.id for m in models):
+            yield from _session_cache.bump(uid)
+
 @asyncio.coroutine
 def cookie2user(cookie_str):
     if not cookie_str:
@@ -50,8 +76,12 @@ def cookie2user(cookie_str):
         if len(L) != 3:
             return None
         uid, expires, sha1 = L
-        if int(expires) < time.time():
+        if not _UID.match(uid) or int(expires) < time.time():
             return None
+        key = yield from _session_key(uid, cookie_str)
+        user = (yield from _session_cache.get(key)) if key is not None else None
+        if user is not None:
+            return User(**user)
         user = yield from User.find(uid)
         if user is None:
             return None
@@ -60,6 +90,9 @@ def cookie2user(cookie_str):
             logging.info('invalid sha1')
             return None
         user.passwd = '******'
+        # 存成dict, 请求处理中修改user不会影响缓存
+        if key is not None:
+            yield from _session_cache.set(key, dict(user), int(expires) - time.time())
         return user
     except Exception as e:
         logging.exception(e)
@@ -85,22 +118,40 @@ def get_page_index(page_str):
         
 @get('/')
 @asyncio.coroutine
-def index(request):
-    blogs = (yield from Blog.findAll())
+def index(*, page='1'):
+    page_index = get_page_index(page)
+    num = yield from Blog.findNumber('count(id)')
+    p = Page(num, page_index)
+    if num == 0:
+        blogs = []
+    else:
+        # 列表页只用到这几列, 不查询content
+        blogs = yield from Blog.findAll(fields=('id', 'name', 'summary', 'created_at'),
+                                        orderBy='created_at desc', limit=(p.offset, p.limit), cache=True)
     return {'__template__':'blogs.html',
+            'page': p,
             'blogs':blogs,
     }
     
 @get('/blog/{id}')
 def get_blog(id):
-    blog = yield from Blog.find(id)
-    comments =yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    # blog和comments互不依赖, 两个查询并发执行
+    blog, comments = yield from asyncio.gather(Blog.find(id),
+                                               Comment.findAll('blog_id=?', [id], orderBy='created_at desc', cache=True))
+    if blog is None:
+        # 页面不是api, 返回真正的404而不是json的错误信息
+        return web.HTTPNotFound()
     if len(comments) > 0:
         for c in comments:
             c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    # markdown转换在执行器中进行, 不阻塞其他请求
+    html = yield from render.blog_html_async(blog, fallback=False)
+    # 转换太慢或排队太多时先显示原文, 这样的页面不进整页缓存
+    blog.html_content = html if html is not None else render.plain(blog.content)
     return {
         '__template__': 'blog.html',
+        '__stream__': True,
+        '__nocache__': html is None,
         'blog': blog,
         'comments': comments
     }
@@ -108,10 +159,17 @@ def get_blog(id):
 @get('/api/blogs/{id}')
 def api_get_blog(*, id):
     blog = yield from Blog.find(id)
+    if blog is not None:
+        blog.html_content = yield from render.blog_html_async(blog)
     return blog
     
 @get('/api/blogs')
-def api_blogs(*, page='1', page_size=5):
+def api_blogs(*, page='1', page_size=5, cursor=None):
+    if cursor is not None:
+        # 传了cursor(第一页为空串)就用keyset分页, 不再count
+        p = CursorPage(cursor, int(page_size) if (int(page_size) > 1) else 1)
+        blogs = yield from Blog.findAll(after=p.after, limit=p.limit)
+        return dict(page=p, blogs=p.paginate(blogs))
     page_index = get_page_index(page)
     num = yield from Blog.findNumber('count(id)')
     p = Page(num, page_index, int(page_size) if (int(page_size) > 1) else 1)
@@ -143,6 +201,15 @@ def manage_edit_blog(id):
         'action': '/api/blogs',
     }
     
+# 内部监控用, /manage/下的路径只有admin能访问
+@get('/manage/metrics')
+def manage_metrics():
+    return {
+        'db': orm.stats(),
+        'render_cache': render.stats(),
+        'session_cache': _session_cache.stats(),
+    }
+
 @get('/register')
 @asyncio.coroutine
 def register():
@@ -206,14 +273,28 @@ def api_create_blog(request, *, name, summary, content):
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, 
                     user_image=request.__user__.image, name=name.strip(), 
                     summary=summary.strip(), content=content.strip())
+    yield from render.prerender_async(blog)
     yield from blog.save()
     return blog
     
+# 编辑页的实时预览
+@post('/api/blogs/preview')
+def api_preview_blog(request, *, content):
+    check_admin(request)
+    html = yield from render.preview(content or '')
+    return dict(html=html)
+    
 @post('/api/blogs/delete')
-def api_blogs_delete(request, *, id):
+async def api_blogs_delete(request, *, id):
     check_admin(request)
-    blog = yield from Blog.find(id)
-    yield from blog.remove()
+    # 日志和它的评论一起删除, 要么都成功要么都不生效
+    async with orm.transaction():
+        blog = await Blog.find(id)
+        if blog is None:
+            raise APIResourceNotFoundError('Blog')
+        await blog.remove()
+        await orm.execute('delete from `comments` where `blog_id`=?', [id])
+    await orm.invalidate(Comment.__table__)
     return dict(id=id)
     
 @post('/api/users')
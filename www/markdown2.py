@@ -87,13 +87,15 @@ import sys
 from pprint import pprint, pformat
 import re
 import logging
-try:
-    from hashlib import md5
-except ImportError:
-    from md5 import md5
 import optparse
-from random import random, randint
+from random import random
 import codecs
+import threading
+import itertools
+import binascii
+import hashlib
+import time
+from collections import OrderedDict
 
 
 #---- Python version compat
@@ -132,9 +134,36 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
+# Placeholders stand in for escaped chars, HTML blocks and spans, code
+# spans and link patterns until the end of conversion. They used to be
+# an MD5 of a salt plus the text; now they are a random per-process
+# nonce plus a counter. The shape is unchanged ('md5-' and 32 hex
+# digits) so no pattern needs to change, a placeholder still cannot be
+# forged without knowing the nonce, and no hashing is done.
+_placeholder_nonce = binascii.hexlify(os.urandom(8)).decode('ascii')
+_placeholder_counter = itertools.count()
+_placeholder_re = re.compile(r'md5-[0-9a-f]{32}')
+
 def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
+    return 'md5-%s%016x' % (_placeholder_nonce, next(_placeholder_counter))
+
+def _restore_placeholders(text, table):
+    """Swap every placeholder in `table` (placeholder -> text) back in
+    one regex pass, repeating while restored text brings in more.
+    Strings that merely look like placeholders are left alone.
+    """
+    while 'md5-' in text:
+        found = []
+        def _sub(match):
+            key = match.group(0)
+            if key in table:
+                found.append(key)
+                return table[key]
+            return key
+        text = _placeholder_re.sub(_sub, text)
+        if not found:
+            break
+    return text
 
 # Table of hash values for escaped characters:
 g_escape_table = dict([(ch, _hash_text(ch))
@@ -165,11 +194,321 @@ def markdown_path(path, encoding="utf-8",
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
-             use_file_vars=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+             use_file_vars=False, profile=False):
+    return converter_pool(html4tags=html4tags, tab_width=tab_width,
+                          safe_mode=safe_mode, extras=extras,
+                          link_patterns=link_patterns,
+                          use_file_vars=use_file_vars,
+                          profile=profile).convert(text)
+
+class MarkdownPool(object):
+    """A pool of pre-built `Markdown` instances sharing one configuration.
+
+    Building a `Markdown` massages the extras, compiles the outdent regex
+    and copies the escape table; a pooled instance only pays for
+    `reset()` on each conversion. An instance is handed to one caller at
+    a time, so a pool can be shared between threads. After a fork the
+    child starts with an empty pool and a fresh lock.
+
+        pool = MarkdownPool(extras=["footnotes"])
+        html = pool.convert(text)
+
+    `markdown_class` is the `Markdown` subclass to build, if not
+    `Markdown` itself.
+    """
+    def __init__(self, markdown_class=None, **kwargs):
+        self._class = markdown_class
+        self._kwargs = kwargs
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._free = []
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._free = []
+
+    def acquire(self):
+        """Return an idle instance, building one if there is none."""
+        self._check_pid()
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return (self._class or Markdown)(**self._kwargs)
+
+    def release(self, md):
+        self._check_pid()
+        with self._lock:
+            self._free.append(md)
+
+    def convert(self, text):
+        md = self.acquire()
+        try:
+            return md.convert(text)
+        finally:
+            self.release(md)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _config_key(html4tags, tab_width, safe_mode, extras, link_patterns,
+                use_file_vars, profile):
+    if isinstance(extras, dict):
+        extras_key = tuple(sorted((k, repr(v)) for k, v in extras.items()))
+    else:
+        extras_key = tuple(sorted(extras or ()))
+    return (html4tags, tab_width, safe_mode, extras_key,
+            repr(link_patterns), use_file_vars, profile)
+
+def _shared(cls, kwargs):
+    key = (cls, _config_key(**kwargs))
+    obj = _pools.get(key)
+    if obj is None:
+        with _pools_lock:
+            obj = _pools.get(key)
+            if obj is None:
+                obj = _pools[key] = cls(**kwargs)
+    return obj
+
+def converter_pool(html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                   safe_mode=None, extras=None, link_patterns=None,
+                   use_file_vars=False, profile=False):
+    """Return the shared `MarkdownPool` for this configuration."""
+    return _shared(MarkdownPool, dict(
+        html4tags=html4tags, tab_width=tab_width, safe_mode=safe_mode,
+        extras=extras, link_patterns=link_patterns,
+        use_file_vars=use_file_vars, profile=profile))
+
+def incremental_converter(html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                          safe_mode=None, extras=None, link_patterns=None,
+                          use_file_vars=False, profile=False):
+    """Return the shared `IncrementalMarkdown` for this configuration."""
+    return _shared(IncrementalMarkdown, dict(
+        html4tags=html4tags, tab_width=tab_width, safe_mode=safe_mode,
+        extras=extras, link_patterns=link_patterns,
+        use_file_vars=use_file_vars, profile=profile))
+
+# Profiling: process-wide totals over every conversion done with
+# `profile=True`. Per-conversion numbers are on the result's `profile`
+# attribute.
+_profile_lock = threading.Lock()
+_profile_totals = {"conversions": 0, "time": 0.0, "stages": {}, "extras": {}}
+
+def _record_profile(profile):
+    with _profile_lock:
+        _profile_totals["conversions"] += 1
+        _profile_totals["time"] += profile["time"]
+        for name, st in profile["stages"].items():
+            total = _profile_totals["stages"].setdefault(
+                name, {"calls": 0, "time": 0.0, "self_time": 0.0})
+            for k in total:
+                total[k] += st[k]
+        for name, t in profile["extras"].items():
+            _profile_totals["extras"][name] = \
+                _profile_totals["extras"].get(name, 0.0) + t
+
+def profile_stats():
+    """Return the process-wide profiling totals: number of conversions,
+    their total wall time, and per stage `calls`, `time` (inclusive,
+    recursion counted once) and `self_time`; per extra, the self time
+    of the stages that implement it.
+    """
+    with _profile_lock:
+        return {"conversions": _profile_totals["conversions"],
+                "time": _profile_totals["time"],
+                "stages": dict((k, dict(v)) for k, v
+                               in _profile_totals["stages"].items()),
+                "extras": dict(_profile_totals["extras"])}
+
+def reset_profile_stats():
+    with _profile_lock:
+        _profile_totals["conversions"] = 0
+        _profile_totals["time"] = 0.0
+        _profile_totals["stages"] = {}
+        _profile_totals["extras"] = {}
+
+class IncrementalMarkdown(object):
+    """Convert a document block by block, caching each block's html.
+
+    The document is split at blank lines into top-level blocks; a block
+    that was converted before (by hash) is not converted again, so
+    re-rendering a long document after a small edit only pays for the
+    blocks that changed. Link definitions from the whole document are
+    appended to every block that contains a '[', and take part in that
+    block's cache key.
+
+    The split is conservative and only happens where `Markdown.convert`
+    would end every block anyway: indented lines, fenced code, and list
+    items or quotes while a list or quote opened earlier in the block
+    may still be going on stay with the block before them. The output
+    is the same as converting the whole document. Documents that need
+    state spanning the whole document are converted in one go: raw HTML
+    blocks (which may contain blank lines), link definitions together
+    with fenced code, and the footnotes, toc, header-ids, metadata and
+    markdown-in-html extras or `use_file_vars`.
+
+        md = IncrementalMarkdown(extras=["fenced-code-blocks"])
+        html = md.convert(text)
+    """
+    whole_document_extras = ("footnotes", "toc", "header-ids", "metadata",
+                             "markdown-in-html")
+    cache_size = 2000
+
+    _html_line_re = re.compile(r"^[ ]{0,3}<", re.M)
+    _list_item_line_re = re.compile(r"^[ \t]*([*+-]|\d+\.)[ \t]")
+    _empty_item_line_re = re.compile(r"^[ \t]*([*+-]|\d+\.)[ \t]+$")
+
+    def __init__(self, **kwargs):
+        self._pool = MarkdownPool(**kwargs)
+        self._block_pool = MarkdownPool(_BlockMarkdown, **kwargs)
+        self.tab_width = kwargs.get("tab_width", DEFAULT_TAB_WIDTH)
+        extras = kwargs.get("extras") or ()
+        self.whole_document = kwargs.get("use_file_vars", False) or \
+            any(e in extras for e in self.whole_document_extras)
+        self.fenced = "fenced-code-blocks" in extras
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        # Counters for the last convert() call.
+        self.last_blocks = 0
+        self.last_converted = 0
+
+    def _fenced_lines(self, text):
+        """Line numbers inside fenced code blocks (after the opening
+        fence), found with convert()'s own regex so the split agrees
+        with it on where a fence is.
+
+        convert() looks for fences twice: in the whole text, and again
+        in _run_block_gamut, where each fence found the first time is
+        a single line with a blank line after it.
+        """
+        fenced = set()
+        lines = (text + "\n\n").split("\n")
+        for i in range(2):
+            text = "\n".join(lines)
+            for m in Markdown._fenced_code_block_re.finditer(text):
+                start = m.end() - len(m.group(0).lstrip("\n"))
+                first = text.count("\n", 0, start)
+                last = text.count("\n", 0, m.end() - 1)
+                fenced.update(range(first + 1, last + 1))
+                lines[first] = "fenced"
+                lines[first + 1:last + 1] = [""] * (last - first)
+        return fenced
+
+    def _split(self, text, fenced=()):
+        blocks = []
+        lines = []
+        started = blank = False
+        # Whether a list or a quote opened anywhere in the current block
+        # may still be going on: only a blank line followed by an
+        # unindented line that is neither a list item nor a quote ends
+        # both.
+        in_list = in_quote = False
+        # An empty list item ("- " while typing a new item) followed by
+        # a single blank line swallows the next block: the list regex
+        # needs at least one character before it can end, and that
+        # character is the newline.  Never cut right after one.
+        empty_item = False
+        for i, line in enumerate(text.split("\n")):
+            if i in fenced:
+                lines.append(line)
+                blank = False
+                continue
+            if not line:
+                blank = True
+                lines.append(line)
+                continue
+            if blank and started and not empty_item and \
+                    not self._continues(line, in_list, in_quote):
+                blocks.append("\n".join(lines))
+                lines = []
+                in_list = in_quote = False
+            started = True
+            blank = False
+            lines.append(line)
+            empty_item = bool(self._empty_item_line_re.match(line))
+            if self._list_item_line_re.match(line):
+                in_list = True
+            if line.lstrip(" \t").startswith(">"):
+                in_quote = True
+        if lines:
+            blocks.append("\n".join(lines))
+        return blocks
+
+    def _continues(self, line, in_list, in_quote):
+        """Whether `line`, after a blank line, belongs to the current
+        block."""
+        # convert() ends lists and code blocks only before a line that
+        # starts with a non-space (`\S`, which includes unicode spaces).
+        if line[0].isspace():
+            return True
+        if self._list_item_line_re.match(line):
+            return in_list
+        if line.startswith(">"):
+            return in_quote
+        return False
+
+    def convert(self, text):
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8')
+        text = re.sub("\r\n|\r", "\n", text)
+        if self.whole_document or self._html_line_re.search(text):
+            self.last_blocks = self.last_converted = 1
+            return self._pool.convert(text)
+        # Empty the whitespace-only lines up front like convert() does:
+        # link definitions swallow the blank lines after them.
+        text = source = Markdown._ws_only_line_re.sub("", text)
+        link_def_re = _link_def_re_from_tab_width(self.tab_width)
+        defs = [m.group(0).strip("\n") for m in link_def_re.finditer(text)]
+        if defs and self.fenced and "```" in text:
+            # convert() looks for fences both before and after it drops
+            # the defs, and a def next to a fence changes which lines
+            # they cover.
+            self.last_blocks = self.last_converted = 1
+            return self._pool.convert(text)
+        fenced = self._fenced_lines(text) if self.fenced else ()
+        if defs:
+            # Like convert(), drop the defs before looking at blocks: a
+            # list on both sides of one is still a single list.
+            text = link_def_re.sub("", text)
+        blocks = self._split(text, fenced)
+        defs = "\n\n" + "\n".join(defs) if defs else ""
+        defs_hash = hashlib.sha1(defs.encode("utf-8")).hexdigest()
+
+        html = []
+        converted = 0
+        for block in blocks:
+            with_defs = defs and "[" in block
+            key = hashlib.sha1(block.encode("utf-8")).hexdigest()
+            if with_defs:
+                key += defs_hash
+            with self._lock:
+                part = self._blocks.get(key)
+                if part is not None:
+                    self._blocks.move_to_end(key)
+            if part is None:
+                md = self._block_pool.acquire()
+                try:
+                    part = unicode(md.convert(
+                        block + defs if with_defs else block)).strip("\n")
+                    if md.open_tag:
+                        part = False
+                finally:
+                    self._block_pool.release(md)
+                converted += 1
+                with self._lock:
+                    self._blocks[key] = part
+                    while len(self._blocks) > self.cache_size:
+                        self._blocks.popitem(last=False)
+            if part is False:
+                # A later block could close the tag this one left open.
+                self.last_blocks = self.last_converted = 1
+                return self._pool.convert(source)
+            if part:
+                html.append(part)
+        self.last_blocks = len(blocks)
+        self.last_converted = converted
+        return "\n\n".join(html) + "\n"
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -192,8 +531,43 @@ class Markdown(object):
 
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
 
+    # Stages timed when profiling, each with the extra it implements
+    # (None for core syntax).
+    _profiled_stages = (
+        ("_detab", None),
+        ("_extract_metadata", "metadata"),
+        ("_do_fenced_code_blocks", "fenced-code-blocks"),
+        ("_hash_html_spans", None),
+        ("_hash_html_blocks", None),
+        ("_strip_footnote_definitions", "footnotes"),
+        ("_strip_link_definitions", None),
+        ("_run_block_gamut", None),
+        ("_do_headers", None),
+        ("_do_lists", None),
+        ("_do_code_blocks", None),
+        ("_do_block_quotes", None),
+        ("_form_paragraphs", None),
+        ("_run_span_gamut", None),
+        ("_do_code_spans", None),
+        ("_escape_special_chars", None),
+        ("_do_links", None),
+        ("_do_auto_links", None),
+        ("_encode_amps_and_angles", None),
+        ("_do_italics_and_bold", None),
+        ("_do_tables", "tables"),
+        ("_do_wiki_tables", "wiki-tables"),
+        ("_do_smart_punctuation", "smarty-pants"),
+        ("_do_link_patterns", "link-patterns"),
+        ("_prepare_pyshell_blocks", "pyshell"),
+        ("_color_with_pygments", "fenced-code-blocks"),
+        ("_add_footnotes", "footnotes"),
+        ("_unescape_special_chars", None),
+        ("_unhash_html_spans", None),
+    )
+
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
-                 extras=None, link_patterns=None, use_file_vars=False):
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 profile=False):
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -226,10 +600,57 @@ class Markdown(object):
         self.use_file_vars = use_file_vars
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
 
-        self._escape_table = g_escape_table.copy()
+        self._base_escape_table = g_escape_table.copy()
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            self._base_escape_table['"'] = _hash_text('"')
+            self._base_escape_table["'"] = _hash_text("'")
+        self._escape_table = self._base_escape_table.copy()
+
+        self.profile = profile
+        if profile:
+            for name, extra in self._profiled_stages:
+                method = getattr(self, name, None)
+                if method is not None:
+                    setattr(self, name, self._profiled(name, method))
+
+    def _profiled(self, name, method):
+        """Wrap a stage method to record its calls, inclusive time and
+        self time (excluding profiled stages it calls)."""
+        def timed(*args, **kwargs):
+            stack = self._profile_stack
+            depth = self._profile_depth
+            stack.append(0.0)
+            depth[name] = depth.get(name, 0) + 1
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                children = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                depth[name] -= 1
+                st = self._profile_stages.get(name)
+                if st is None:
+                    st = self._profile_stages[name] = \
+                        {"calls": 0, "time": 0.0, "self_time": 0.0}
+                st["calls"] += 1
+                st["self_time"] += elapsed - children
+                # A recursive stage (e.g. _run_block_gamut) counts its
+                # inclusive time once, at the outermost call.
+                if not depth[name]:
+                    st["time"] += elapsed
+        return timed
+
+    def _profile_result(self, elapsed):
+        extras = {}
+        for name, extra in self._profiled_stages:
+            if extra is not None and extra in self.extras \
+                    and name in self._profile_stages:
+                extras[extra] = extras.get(extra, 0.0) \
+                    + self._profile_stages[name]["self_time"]
+        return {"time": elapsed, "stages": self._profile_stages,
+                "extras": extras}
 
     def reset(self):
         self.urls = {}
@@ -238,6 +659,11 @@ class Markdown(object):
         self.html_spans = {}
         self.list_level = 0
         self.extras = self._instance_extras.copy()
+        # Code spans add entries to the escape table and the toc is
+        # built up per document; drop both so a reused instance starts
+        # from the same state as a new one.
+        self._escape_table = self._base_escape_table.copy()
+        self._toc = None
         if "footnotes" in self.extras:
             self.footnotes = {}
             self.footnote_ids = []
@@ -245,6 +671,10 @@ class Markdown(object):
             self._count_from_header_id = {} # no `defaultdict` in Python 2.4
         if "metadata" in self.extras:
             self.metadata = {}
+        if self.profile:
+            self._profile_stages = {}
+            self._profile_stack = []
+            self._profile_depth = {}
 
     # Per <https://developer.mozilla.org/en-US/docs/HTML/Element/a> "rel"
     # should only be used in <a> tags with an "href" attribute.
@@ -262,6 +692,8 @@ class Markdown(object):
         # one article (e.g. an index page that shows the N most recent
         # articles):
         self.reset()
+        if self.profile:
+            start = time.perf_counter()
 
         if not isinstance(text, unicode):
             #TODO: perhaps shouldn't presume UTF-8 for string input?
@@ -346,6 +778,9 @@ class Markdown(object):
             rv._toc = self._toc
         if "metadata" in self.extras:
             rv.metadata = self.metadata
+        if self.profile:
+            rv.profile = self._profile_result(time.perf_counter() - start)
+            _record_profile(rv.profile)
         return rv
 
     def postprocess(self, text):
@@ -697,28 +1132,7 @@ class Markdown(object):
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
-        # Link defs are in the form:
-        #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
+        _link_def_re = _link_def_re_from_tab_width(self.tab_width)
         return _link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
@@ -1035,9 +1449,7 @@ class Markdown(object):
         return ''.join(tokens)
 
     def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
+        return _restore_placeholders(text, self.html_spans)
 
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
@@ -1516,36 +1928,11 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _pygments_lexer(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
-        import pygments
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-
-            def wrap(self, source, outfile):
-                """Return the source with a code, pre, and div."""
-                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
-
         formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        return _pygments_highlight(codeblock, lexer, formatter_opts)
 
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
@@ -1704,8 +2091,11 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
-        self._escape_table[text] = hashed
+        # The same code text must map to the same placeholder: the table
+        # is keyed by text, so a second entry would orphan the first.
+        hashed = self._escape_table.get(text)
+        if hashed is None:
+            hashed = self._escape_table[text] = _hash_text(text)
         return hashed
 
     _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
@@ -1886,6 +2276,9 @@ class Markdown(object):
         return text
 
     def _encode_backslash_escapes(self, text):
+        # Every pattern starts with a backslash; most tokens have none.
+        if '\\' not in text:
+            return text
         for ch, escape in list(self._escape_table.items()):
             text = text.replace("\\"+ch, escape)
         return text
@@ -1960,21 +2353,42 @@ class Markdown(object):
                 hash = _hash_text(link)
                 link_from_hash[hash] = link
                 text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+        return _restore_placeholders(text, link_from_hash)
 
     def _unescape_special_chars(self, text):
         # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
-        return text
+        if 'md5-' not in text:
+            return text
+        return _restore_placeholders(
+            text, dict((hash, ch) for ch, hash in self._escape_table.items()))
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
         return self._outdent_re.sub('', text)
 
 
+class _BlockMarkdown(Markdown):
+    """`Markdown` for the blocks of an `IncrementalMarkdown`, noting in
+    `open_tag` whether the html generated for the block leaves a
+    block-level tag without its end tag. Converting the whole document,
+    the html block hashing would look for that end tag in the blocks
+    after it.
+    """
+    _open_tag_re = re.compile(r"^<(%s)\b" % Markdown._block_tags_a, re.M)
+    open_tag = False
+
+    def reset(self):
+        Markdown.reset(self)
+        self.open_tag = False
+
+    def _form_paragraphs(self, text):
+        # Matched blocks are hashed by now; any block tag left at the
+        # start of a line found no end tag.
+        if self._open_tag_re.search(text):
+            self.open_tag = True
+        return Markdown._form_paragraphs(self, text)
+
+
 class MarkdownWithExtras(Markdown):
     """A markdowner class that enables most extras:
     - footnotes
@@ -2191,6 +2605,82 @@ class _memoized(object):
       return self.func.__doc__
 
 
+# Pygments support. Lexers and formatters are looked up once per name
+# and option set, and highlighted blocks are kept in a small LRU keyed
+# by a hash of the code plus the lexer and formatter options, so a
+# snippet repeated across posts (or re-rendered) is highlighted once.
+HIGHLIGHT_CACHE_SIZE = 1000
+_pygments_lock = threading.Lock()
+_pygments_lexers = {}
+_pygments_formatters = {}
+_highlighted = OrderedDict()
+
+@_memoized
+def _html_code_formatter_class():
+    import pygments.formatters
+
+    class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+        def _wrap_code(self, inner):
+            """A function for use in a Pygments Formatter which
+            wraps in <code> tags.
+            """
+            yield 0, "<code>"
+            for tup in inner:
+                yield tup
+            yield 0, "</code>"
+
+        def wrap(self, source, outfile=None):
+            """Return the source with a code, pre, and div."""
+            # Pygments 2.12 dropped the `outfile` argument and adds
+            # the div itself.
+            if outfile is None:
+                return self._wrap_pre(self._wrap_code(source))
+            return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
+
+    return HtmlCodeFormatter
+
+def _pygments_lexer(lexer_name):
+    """Return the lexer for `lexer_name`, or None if pygments is not
+    installed or has no such lexer. Misses are cached too.
+    """
+    try:
+        return _pygments_lexers[lexer_name]
+    except KeyError:
+        pass
+    try:
+        from pygments import lexers, util
+    except ImportError:
+        lexer = None
+    else:
+        try:
+            lexer = lexers.get_lexer_by_name(lexer_name)
+        except util.ClassNotFound:
+            lexer = None
+    _pygments_lexers[lexer_name] = lexer
+    return lexer
+
+def _pygments_highlight(codeblock, lexer, formatter_opts):
+    import pygments
+    opts_key = repr(sorted(formatter_opts.items()))
+    lexer_key = (type(lexer).__name__, repr(sorted(lexer.options.items())))
+    key = (hashlib.sha1(codeblock.encode("utf-8")).hexdigest(),
+           lexer_key, opts_key)
+    with _pygments_lock:
+        if key in _highlighted:
+            _highlighted.move_to_end(key)
+            return _highlighted[key]
+        formatter = _pygments_formatters.get(opts_key)
+        if formatter is None:
+            formatter = _pygments_formatters[opts_key] = \
+                _html_code_formatter_class()(**formatter_opts)
+    colored = pygments.highlight(codeblock, lexer, formatter)
+    with _pygments_lock:
+        _highlighted[key] = colored
+        while len(_highlighted) > HIGHLIGHT_CACHE_SIZE:
+            _highlighted.popitem(last=False)
+    return colored
+
+
 def _xml_oneliner_re_from_tab_width(tab_width):
     """Standalone XML processing instruction regex."""
     return re.compile(r"""
@@ -2231,6 +2721,30 @@ def _hr_tag_re_from_tab_width(tab_width):
         """ % (tab_width - 1), re.X)
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
+def _link_def_re_from_tab_width(tab_width):
+    """Link definition regex. Link defs are in the form:
+        [id]: url "optional title"
+    """
+    return re.compile(r"""
+        ^[ ]{0,%d}\[(.+)\]: # id = \1
+          [ \t]*
+          \n?               # maybe *one* newline
+          [ \t]*
+        <?(.+?)>?           # url = \2
+          [ \t]*
+        (?:
+            \n?             # maybe one newline
+            [ \t]*
+            (?<=\s)         # lookbehind for whitespace
+            ['"(]
+            ([^\n]*)        # title = \3
+            ['")]
+            [ \t]*
+        )?  # title is optional
+        (?:\n+|\Z)
+        """ % (tab_width - 1), re.X | re.M | re.U)
+_link_def_re_from_tab_width = _memoized(_link_def_re_from_tab_width)
+
 
 def _xml_escape_attr(attr, skip_single_quote=True):
     """Escape the given string for use in an HTML/XML tag attribute.
@@ -30,6 +30,9 @@ class Blog(orm.Model):
     name = orm.StringField(ddl='varchar(50)')
     summary = orm.StringField(ddl='varchar(200)')
     content = orm.TextField()
+    # 写入时预先渲染好的html, render_version对应渲染时的markdown2版本和extras
+    html_content = orm.TextField()
+    render_version = orm.StringField(ddl='varchar(50)')
     created_at = orm.FloatField(default=time.time)
 
 class Comment(orm.Model):
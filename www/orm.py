@@ -3,19 +3,93 @@
 import aiomysql
 import asyncio
 import logging
+import sys
+import time
+import bisect
+import itertools
+import collections
+import contextvars
+import hashlib
 
 from config import configs
+from cache import Namespace
 
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
+
+# 写操作的监听函数, Model.save/update/remove成功执行后调用func(models, action), func是协程
+# models是同一个Model类的对象列表, save_many/update_many每批只通知一次
+# 缓存之类的模块通过它来做失效处理, 自己对表和id去重
+_listeners = []
+
+def add_listener(func):
+    _listeners.append(func)
+    return func
+
+@asyncio.coroutine
+def notify(models, action):
+    if not models:
+        return
+    tx = _tx.get()
+    if tx is not None:
+        tx.pending.append((models, action))
+        return
+    for func in _listeners:
+        try:
+            yield from func(models, action)
+        except Exception as e:
+            logging.exception(e)
     
+# sql语句里的?占位符要换成驱动用的%s
+# 同样形状的语句只转换一次, 结果缓存起来
+SQL_CACHE_SIZE = 2000
+_sql_cache = {}
+# findAll的(表, where, orderBy, ...)形状 => sql
+_shape_cache = {}
+_sql_stats = dict(hits=0, misses=0, shape_hits=0, shape_misses=0)
+
+def translate(sql):
+    try:
+        s = _sql_cache[sql]
+        _sql_stats['hits'] += 1
+        return s
+    except KeyError:
+        _sql_stats['misses'] += 1
+        if len(_sql_cache) >= SQL_CACHE_SIZE:
+            _sql_cache.clear()
+        s = _sql_cache[sql] = sql.replace('?', '%s')
+        return s
+
+def sql_cache_stats():
+    stats = dict(_sql_stats, size=len(_sql_cache), shapes=len(_shape_cache))
+    for k in ('', 'shape_'):
+        total = stats[k + 'hits'] + stats[k + 'misses']
+        stats[k + 'hit_rate'] = stats[k + 'hits'] / total if total else 0.0
+    return stats
+
+# 读写分离: 写操作(execute)和事务走主库__pool, select分给从库
+# balance: 'round-robin'轮流选择, 'least-busy'选当前占用连接最少的从库
+# 本请求刚写过数据时, STICKY_SECONDS内的读仍走主库, 保证读到自己的写
+# 从库出错时改查主库, 并在REPLICA_RETRY秒内不再使用该从库
+STICKY_SECONDS = 5
+REPLICA_RETRY = 30
+_replicas = []
+_replica_down = {}
+_balance = 'round-robin'
+_rr = itertools.count()
+_last_write = contextvars.ContextVar('last_write', default=0)
+# 要写进缓存的结果从主库读: 否则从库延迟的旧数据会以新的版本号缓存下来, 几毫秒的延迟变成几十秒的旧数据
+_read_primary = contextvars.ContextVar('read_primary', default=False)
+
+def read_primary():
+    ' route the remaining reads of the current request to the primary. '
+    _read_primary.set(True)
+
 @asyncio.coroutine
-def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
-    global __pool
-    __pool = yield from aiomysql.create_pool(
-        host=kw.get('host', configs.db.host),
-        port=kw.get('port', configs.db.port),
+def _create_pool(loop, kw, host, port):
+    return (yield from aiomysql.create_pool(
+        host=host,
+        port=port,
         user=kw['user'],
         password=kw['pwd'],
         db=kw['db'],
@@ -24,39 +98,304 @@ def create_pool(loop, **kw):
         maxsize=kw.get('maxsize', 10),
         minsize=kw.get('minsize', 1),
         loop=loop,
-    )
-    
+    ))
+
+@asyncio.coroutine
+def create_pool(loop, **kw):
+    logging.info('create database connection pool...')
+    global __pool, _balance, SLOW_QUERY_THRESHOLD
+    SLOW_QUERY_THRESHOLD = kw.get('slow_query_threshold', SLOW_QUERY_THRESHOLD)
+    __pool = yield from _create_pool(loop, kw, kw.get('host', configs.db.host), kw.get('port', configs.db.port))
+    _balance = kw.get('balance', 'round-robin')
+    del _replicas[:]
+    for r in kw.get('replicas', ()):
+        logging.info('create replica connection pool: %s' % r['host'])
+        rkw = dict(kw)
+        rkw.update(r)
+        if 'password' in r:
+            rkw['pwd'] = r['password']
+        try:
+            _replicas.append((yield from _create_pool(loop, rkw, r['host'], r.get('port', configs.db.port))))
+        except Exception as e:
+            logging.warning('replica %s unavailable: %s' % (r['host'], e))
+
+@asyncio.coroutine
+def close_pool():
+    ' close the primary and replica pools, waiting for connections in use. '
+    pools = list(_replicas)
+    if '__pool' in globals():
+        pools.append(__pool)
+    for p in pools:
+        p.close()
+        yield from p.wait_closed()
+    del _replicas[:]
+
+def _read_pool():
+    if not _replicas or _tx_conn.get() is not None or _read_primary.get():
+        return None
+    if time.time() - _last_write.get() < STICKY_SECONDS:
+        return None
+    now = time.time()
+    pools = [p for p in _replicas if _replica_down.get(id(p), 0) <= now]
+    if not pools:
+        return None
+    if _balance == 'least-busy':
+        return min(pools, key=lambda p: p.size - p.freesize)
+    return pools[next(_rr) % len(pools)]
     
+# 事务中固定使用的连接, select/execute发现有它时不再从连接池取连接
+_tx_conn = contextvars.ContextVar('tx_conn', default=None)
+_tx = contextvars.ContextVar('tx', default=None)
+
+# 连接池和查询的统计, 通过stats()取出
+# 等待连接的时间, 每条sql的执行时间直方图, 超过SLOW_QUERY_THRESHOLD秒的记入慢查询日志
+SLOW_QUERY_THRESHOLD = 0.5
+SLOW_LOG_SIZE = 100
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+_pool_stats = dict(checkouts=0, wait_total=0.0, wait_max=0.0, waiting=0)
+_query_stats = {}
+_slow_log = collections.deque(maxlen=SLOW_LOG_SIZE)
+
+def _histogram():
+    return [0] * (len(HISTOGRAM_BUCKETS) + 1)
+
+@asyncio.coroutine
+def _checkout(pool):
+    start = time.time()
+    _pool_stats['waiting'] += 1
+    try:
+        cm = yield from pool
+    finally:
+        _pool_stats['waiting'] -= 1
+    _record_checkout(time.time() - start)
+    return cm
+
+def _record_checkout(wait):
+    _pool_stats['checkouts'] += 1
+    _pool_stats['wait_total'] += wait
+    _pool_stats['wait_max'] = max(_pool_stats['wait_max'], wait)
+
+# 参数里可能有密码的hash之类, 慢查询日志和metrics里只记sql, executemany记行数
+def _record_query(sql, elapsed, rows=None):
+    st = _query_stats.get(sql)
+    if st is None:
+        if len(_query_stats) >= SQL_CACHE_SIZE:
+            _query_stats.clear()
+        st = _query_stats[sql] = dict(count=0, total=0.0, max=0.0, histogram=_histogram())
+    st['count'] += 1
+    st['total'] += elapsed
+    st['max'] = max(st['max'], elapsed)
+    st['histogram'][bisect.bisect_left(HISTOGRAM_BUCKETS, elapsed)] += 1
+    if elapsed >= SLOW_QUERY_THRESHOLD:
+        logging.warning('slow query (%.3fs): %s' % (elapsed, sql) + (' (%s rows)' % rows if rows is not None else ''))
+        _slow_log.append(dict(sql=sql, rows=rows, time=elapsed, at=time.time()))
+
+def _pool_gauge(pool):
+    return dict(size=pool.size, maxsize=pool.maxsize, free=pool.freesize, in_use=pool.size - pool.freesize)
+
+def stats():
+    ' pool, query and sql-cache statistics, for the metrics endpoint. '
+    histogram = _histogram()
+    queries = {}
+    for sql, st in _query_stats.items():
+        queries[sql] = dict(st, avg=st['total'] / st['count'])
+        for i, n in enumerate(st['histogram']):
+            histogram[i] += n
+    pool = __pool if '__pool' in globals() else None
+    return dict(
+        pool=_pool_gauge(pool) if pool is not None else None,
+        replicas=[dict(_pool_gauge(p), down=_replica_down.get(id(p), 0) > time.time()) for p in _replicas],
+        checkout=dict(_pool_stats, wait_avg=_pool_stats['wait_total'] / _pool_stats['checkouts'] if _pool_stats['checkouts'] else 0.0),
+        buckets=list(HISTOGRAM_BUCKETS),
+        histogram=histogram,
+        queries=queries,
+        slow_queries=list(_slow_log),
+        sql_cache=sql_cache_stats(),
+        query_cache=query_cache_stats(),
+    )
+
+@asyncio.coroutine
+def _select(conn, sql, args, size, tuples=False):
+    start = time.time()
+    # tuples为True时每行是tuple, 不生成dict
+    cur = yield from conn.cursor(aiomysql.Cursor if tuples else aiomysql.DictCursor)
+    yield from cur.execute(translate(sql), args or ())
+    if size:
+        rs = yield from cur.fetchmany(size)
+    else:
+        rs = yield from cur.fetchall()
+    yield from cur.close()
+    _record_query(sql, time.time() - start)
+    logging.info('rows returned: %s' % len(rs))
+    return rs
+
+# 只有连不上, 连接断开(客户端错误码2xxx)才算从库故障
+# 1054字段不存在, 1205锁等待超时之类是语句本身的错误, 换到主库执行也一样
+def _connection_error(e):
+    if isinstance(e, (aiomysql.InterfaceError, OSError)):
+        return True
+    code = e.args[0] if e.args else None
+    return isinstance(code, int) and 2000 <= code < 3000
+
 @asyncio.coroutine
-def select(sql, args, size=None):
+def select(sql, args, size=None, tuples=False, primary=False):
     log(sql, args)
+    conn = _tx_conn.get()
+    if conn is not None:
+        return (yield from _select(conn, sql, args, size, tuples))
+    pool = _read_pool() if not primary else None
+    if pool is not None:
+        try:
+            with (yield from _checkout(pool)) as conn:
+                return (yield from _select(conn, sql, args, size, tuples))
+        except (aiomysql.OperationalError, aiomysql.InterfaceError, OSError) as e:
+            if not _connection_error(e):
+                raise
+            logging.warning('replica failed, fallback to primary: %s' % e)
+            _replica_down[id(pool)] = time.time() + REPLICA_RETRY
     global __pool
-    with (yield from __pool) as conn:
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        yield from cur.execute(sql.replace('?', '%s'), args or ())
-        if size:
-            rs = yield from cur.fetchmany(size)
-        else:
-            rs = yield from cur.fetchall()
-        yield from cur.close()
-        logging.info('rows returned: %s' % len(rs))
-        return rs
+    with (yield from _checkout(__pool)) as conn:
+        return (yield from _select(conn, sql, args, size, tuples))
+
+@asyncio.coroutine
+def _execute(conn, sql, args, many=False):
+    start = time.time()
+    cur = yield from conn.cursor()
+    if many:
+        yield from cur.executemany(translate(sql), args)
+    else:
+        yield from cur.execute(translate(sql), args)
+    affected = cur.rowcount
+    yield from cur.close()
+    _record_query(sql, time.time() - start, len(args) if many else None)
+    return affected
 
 # insert， update， delete都可以用这个执行
 # 因为与select不同， 这三个命令只需要返回结果数        
 @asyncio.coroutine
 def execute(sql, args):
     log(sql)
-    with (yield from __pool) as conn:
+    _last_write.set(time.time())
+    conn = _tx_conn.get()
+    if conn is not None:
+        return (yield from _execute(conn, sql, args))
+    with (yield from _checkout(__pool)) as conn:
+        return (yield from _execute(conn, sql, args))
+        
+# 同一条语句配多组参数, 一次取连接执行
+# insert ... values (...)会被驱动改写成一条多行values的insert
+@asyncio.coroutine
+def execute_many(sql, seq_of_args):
+    log(sql)
+    _last_write.set(time.time())
+    conn = _tx_conn.get()
+    if conn is not None:
+        return (yield from _execute(conn, sql, seq_of_args, True))
+    with (yield from _checkout(__pool)) as conn:
+        return (yield from _execute(conn, sql, seq_of_args, True))
+
+def get_pool():
+    return __pool
+
+# 用法:
+#     async with orm.transaction():
+#         await blog.remove()
+#         await orm.execute('delete from `comments` where `blog_id`=?', [blog.id])
+# 块内的语句都在同一个连接上执行, 正常退出时提交一次, 出异常则回滚
+# 写操作的监听函数也推迟到提交之后才调用
+# 注意块内不要用asyncio.gather并发执行语句, 它们会共用这一个连接
+class Transaction(object):
+    def __init__(self):
+        self.conn = None
+        self.pending = []
+        self._nested = False
+
+    async def __aenter__(self):
+        if _tx_conn.get() is not None:
+            # 已经在事务里了, 直接并入外层事务
+            self._nested = True
+            return _tx.get()
+        start = time.time()
+        self.conn = await get_pool().acquire()
+        _record_checkout(time.time() - start)
         try:
-            cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace('?', '%s'), args)
-            affected = cur.rowcount
-            yield from cur.close()
-        except BaseException as e:
+            await self.conn.begin()
+        except BaseException:
+            get_pool().release(self.conn)
             raise
-        return affected
-        
+        self._conn_token = _tx_conn.set(self.conn)
+        self._tx_token = _tx.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._nested:
+            return False
+        _tx_conn.reset(self._conn_token)
+        _tx.reset(self._tx_token)
+        try:
+            if exc_type is None:
+                await self.conn.commit()
+            else:
+                await self.conn.rollback()
+        finally:
+            get_pool().release(self.conn)
+        if exc_type is None:
+            # 同一个类同一种操作合并成一次通知
+            batches = collections.OrderedDict()
+            for models, action in self.pending:
+                batches.setdefault((type(models[0]), action), []).extend(models)
+            for (cls, action), models in batches.items():
+                await notify(models, action)
+        return False
+
+def transaction():
+    return Transaction()
+
+# 查询结果缓存: 以(各表的版本号, sql, args)的sha1为key缓存select返回的行, 存在共享的缓存后端里
+# 某个表有写操作时它的版本号加1, 涉及该表的旧缓存不会再命中, 由后端自然淘汰
+# 事务中的查询不走缓存
+QUERY_CACHE_TTL = 60
+COUNT_CACHE_TTL = 60
+_query_cache = Namespace('query')
+
+@asyncio.coroutine
+def invalidate(*tables):
+    ' mark cached query results of these tables stale, e.g. after a raw execute(). '
+    for t in tables:
+        yield from _query_cache.bump(t)
+
+@add_listener
+@asyncio.coroutine
+def _invalidate_table(models, action):
+    yield from invalidate(models[0].__table__)
+
+def _rows_size(rs):
+    return sys.getsizeof(rs) + sum(sys.getsizeof(r) for r in rs)
+
+@asyncio.coroutine
+def cached_select(tables, sql, args, size=None, tuples=False, ttl=QUERY_CACHE_TTL):
+    if _tx_conn.get() is not None:
+        return (yield from select(sql, args, size, tuples))
+    versions = []
+    for t in tables:
+        v = yield from _query_cache.version(t)
+        if v is None:
+            # 拿不到版本号时不读也不写缓存, 否则写进去的条目以后无法失效
+            return (yield from select(sql, args, size, tuples))
+        versions.append((t, v))
+    key = hashlib.sha1(repr((versions, sql, list(args or ()), size, tuples)).encode('utf-8')).hexdigest()
+    rs = yield from _query_cache.get(key)
+    if rs is None:
+        rs = yield from select(sql, args, size, tuples, primary=True)
+        yield from _query_cache.set(key, list(rs), ttl, _rows_size(rs))
+    return rs
+
+def query_cache_stats():
+    return _query_cache.stats()
+
+# save_many/update_many每批的行数
+BATCH_SIZE = 500
+
 # 下面开始弄models相关类
 # 原文件里，是直接建立的Model和Field类
 
@@ -65,6 +404,24 @@ def create_args_string(num):
     for i in range(num):
         L.append('?')
     return ', '.join(L)
+
+# keyset分页的条件, 例如fields=('created_at', 'id'), 降序时生成
+# ((`created_at`<?) or (`created_at`=? and `id`<?))
+# 只依赖索引定位, 不像offset那样要先扫过前面所有的行
+def seek_condition(fields, desc=True):
+    op = '<' if desc else '>'
+    conds = []
+    for i, f in enumerate(fields):
+        cond = ['`%s`=?' % k for k in fields[:i]]
+        cond.append('`%s`%s?' % (f, op))
+        conds.append('(%s)' % ' and '.join(cond))
+    return '(%s)' % ' or '.join(conds)
+
+def seek_args(values):
+    args = []
+    for i in range(len(values)):
+        args.extend(values[:i+1])
+    return args
     
 class Field(object):
     def __init__(self, name, column_type, primary_key, default):
@@ -96,6 +453,47 @@ class TextField(Field):
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
 
+# Model继承dict, 每个对象都带一个dict, 属性访问还要经过__getattr__
+# 大量对象只读展示时可以用Record: 用__slots__存字段, 更省内存, 属性访问也更快
+# 每个Model子类由ModelMetaclass生成对应的Record类, 即cls.__record__
+# Record只能保存表中的列, 不能像Model那样随意添加属性
+class Record(object):
+    __slots__ = ()
+
+    def __init__(self, **kw):
+        for k in self.__slots__:
+            setattr(self, k, kw.get(k))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.__slots__]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.items() == other.items()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % kv for kv in self.items()))
+
 class ModelMetaclass(type):
     def __new__(cls, name, bases, attrs):
         if name == 'Model':
@@ -134,7 +532,7 @@ class ModelMetaclass(type):
         # python3取消了`， 这里用这个是为了输出sql语句
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
         attrs['__mappings__'] = mappings
-        attrs['__table__'] == tableName
+        attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey
         attrs['__fields__'] = fields
         # 就是一个选择tablename中所有属性的select语句
@@ -147,6 +545,11 @@ class ModelMetaclass(type):
                                 ', '.join(map(lambda i: '`%s`=?' % (mappings.get(i).name or i), fields)),
                                 primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+        attrs['__find__'] = '%s where `%s`=?' % (attrs['__select__'], primaryKey)
+        # 预先转换好这些固定语句
+        for k in ('__select__', '__insert__', '__update__', '__delete__', '__find__'):
+            translate(attrs[k])
+        attrs['__record__'] = type('%sRecord' % name, (Record,), dict(__slots__=tuple([primaryKey] + fields)))
             
         return type.__new__(cls, name, bases, attrs)
         
@@ -191,43 +594,175 @@ class Model(dict, metaclass=ModelMetaclass):
     @classmethod
     @asyncio.coroutine
     def findAll(cls, where=None, args=None, **kw):
-        sql = [cls.__select__]
-        # 回头熟悉下sql语句去
-        # select * from User where id=2
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
-            
+        # 不修改调用者传入的args
+        args = list(args) if args else []
+        # after: 上一页最后一条记录的seek字段值, 默认按(created_at, 主键)降序翻页
+        # 第一页传after=None: 不加条件, 但同样按seek字段排序
+        after = kw.get('after', None)
+        seek, desc = None, None
+        if 'after' in kw or 'seek' in kw:
+            seek = tuple(kw.get('seek', ('created_at', cls.__primary_key__)))
+            desc = kw.get('desc', True)
+            if after is not None:
+                if len(after) != len(seek):
+                    raise ValueError('Invalid after value: %s' % str(after))
+                args.extend(seek_args(after))
         orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
         limit = kw.get('limit', None)
         if limit is not None:
-            sql.append('limit')
             if isinstance(limit, int):
-                sql.append('?')
                 args.append(limit)
+                limit = 1
             elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
                 args.extend(limit)
+                limit = 2
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        print('select: %s \n args: %s' % (' '.join(sql), args))
-        rs = yield from select(' '.join(sql), args)
+        # fields: 只查询这些列, 例如列表页不需要content
+        # tuples: 直接返回tuple的列表, 顺序和fields(默认是主键+__fields__)一致, 不生成Model
+        fields = kw.get('fields', None)
+        if fields is not None:
+            fields = tuple(fields)
+            for f in fields:
+                if f not in cls.__mappings__:
+                    raise ValueError('Invalid field: %s' % f)
+        tuples = kw.get('tuples', False)
+        # compact: 返回cls.__record__对象而不是Model
+        compact = kw.get('compact', False)
+        # 参数不同但形状相同的查询共用一条sql
+        shape = (cls.__table__, fields, where, orderBy, seek, desc, after is not None, limit)
+        sql = _shape_cache.get(shape)
+        if sql is None:
+            _sql_stats['shape_misses'] += 1
+            sql = cls._findAllSql(fields, where, orderBy, seek, desc, limit, after is not None)
+            if len(_shape_cache) >= SQL_CACHE_SIZE:
+                _shape_cache.clear()
+            _shape_cache[shape] = sql
+        else:
+            _sql_stats['shape_hits'] += 1
+        # cache: True或缓存秒数, 结果在该表有写操作时失效
+        ttl = kw.get('cache', None)
+        if ttl:
+            rs = yield from cached_select((cls.__table__,), sql, args, tuples=tuples,
+                                          ttl=QUERY_CACHE_TTL if ttl is True else ttl)
+        else:
+            rs = yield from select(sql, args, tuples=tuples)
+        if tuples:
+            return rs
+        if compact:
+            record = cls.__record__
+            return [record(**r) for r in rs]
         return [cls(**r) for r in rs]
-        
+
     @classmethod
-    @asyncio.coroutine
-    def findNumber(cls, selectField, where=None, args=None):
-        ' find number by select and where. '
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+    def _findAllSql(cls, fields, where, orderBy, seek, desc, limit, after=False):
+        if fields is None:
+            sql = [cls.__select__]
+        else:
+            sql = ['select %s from `%s`' % (', '.join('`%s`' % f for f in fields), cls.__table__)]
+        if seek is not None:
+            if after:
+                cond = seek_condition(seek, desc)
+                where = '(%s) and %s' % (where, cond) if where else cond
+            if orderBy is None:
+                orderBy = ', '.join('`%s` %s' % (f, 'desc' if desc else 'asc') for f in seek)
+        # 回头熟悉下sql语句去
+        # select * from User where id=2
         if where:
             sql.append('where')
             sql.append(where)
-        rs = yield from select(' '.join(sql), args, 1)
+        if orderBy:
+            sql.append('order by')
+            sql.append(orderBy)
+        if limit is not None:
+            sql.append('limit')
+            sql.append('?' if limit == 1 else '?, ?')
+        return ' '.join(sql)
+        
+    # 用服务器端游标(SSDictCursor)分批读取, 结果集再大也只占一批的内存:
+    #     async for blog in Blog.iterate(batch=200):
+    #         ...
+    # 迭代期间一直占用一个连接; 在事务中使用时共用事务的连接, 迭代完之前不能在事务里执行其他语句
+    @classmethod
+    async def iterate(cls, where=None, args=None, batch=100, **kw):
+        fields = tuple(kw['fields']) if kw.get('fields') else None
+        make = cls.__record__ if kw.get('compact', False) else cls
+        sql = cls._findAllSql(fields, where, kw.get('orderBy', None), None, None, None)
+        log(sql, args)
+        pool = None
+        conn = _tx_conn.get()
+        if conn is None:
+            pool = _read_pool() or get_pool()
+            start = time.time()
+            conn = await pool.acquire()
+            _record_checkout(time.time() - start)
+        try:
+            cur = await conn.cursor(aiomysql.SSDictCursor)
+            try:
+                await cur.execute(translate(sql), args or ())
+                while True:
+                    rs = await cur.fetchmany(batch)
+                    if not rs:
+                        break
+                    for r in rs:
+                        yield make(**r)
+            finally:
+                # 提前结束时close会读完剩下的行, 连接才能继续使用
+                await cur.close()
+        finally:
+            if pool is not None:
+                pool.release(conn)
+
+    @classmethod
+    @asyncio.coroutine
+    def findIn(cls, field, values, where=None, args=None, **kw):
+        ' find objects whose field is one of values, in a single query. '
+        values = list(values)
+        if not values:
+            return []
+        cond = '`%s` in (%s)' % (field, create_args_string(len(values)))
+        if where:
+            cond = '%s and (%s)' % (cond, where)
+        return (yield from cls.findAll(cond, values + list(args or []), **kw))
+
+    # 一次查询加载多个对象的关联记录, 避免每个对象单独查一次(N+1)
+    # 例如: yield from Comment.loadRelated(blogs, 'blog_id', 'comments')
+    # 之后每个blog.comments都是该blog的评论列表
+    @classmethod
+    @asyncio.coroutine
+    def loadRelated(cls, models, foreign_key, attr, **kw):
+        ' attach related objects of cls to each model as model[attr]. '
+        if not models:
+            return models
+        pk = models[0].__primary_key__
+        related = yield from cls.findIn(foreign_key, set(m[pk] for m in models), **kw)
+        groups = dict()
+        for r in related:
+            groups.setdefault(r[foreign_key], []).append(r)
+        for m in models:
+            m[attr] = groups.get(m[pk], [])
+        return models
+
+    # ttl: 结果缓存的秒数, 0表示不缓存; 该表有写操作时缓存立即失效
+    # approximate: 不带where时直接读information_schema里的行数统计, 不扫表
+    # (InnoDB的table_rows是估计值, 只适合分页之类不要求精确的地方)
+    @classmethod
+    @asyncio.coroutine
+    def findNumber(cls, selectField, where=None, args=None, ttl=COUNT_CACHE_TTL, approximate=False):
+        ' find number by select and where. '
+        if approximate and not where:
+            sql = 'select `table_rows` _num_ from information_schema.tables where `table_schema`=database() and `table_name`=?'
+            args = [cls.__table__]
+        else:
+            sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            sql = ' '.join(sql)
+        if ttl:
+            rs = yield from cached_select((cls.__table__,), sql, args, 1, ttl=ttl)
+        else:
+            rs = yield from select(sql, args, 1)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
@@ -236,11 +771,65 @@ class Model(dict, metaclass=ModelMetaclass):
     @asyncio.coroutine
     def find(cls, pk):
         ' find object by primary key. '
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        rs = yield from select(cls.__find__, [pk], 1)
         if len(rs) == 0:
             return None
         return cls(**rs[0])
 
+    @classmethod
+    @asyncio.coroutine
+    def save_many(cls, models, batch_size=BATCH_SIZE):
+        ' insert models in batches, return the affected rows of each batch. '
+        results = []
+        for i in range(0, len(models), batch_size):
+            batch = models[i:i+batch_size]
+            seq = []
+            for m in batch:
+                args = list(map(m.getValueOrDefault, cls.__fields__))
+                args.append(m.getValueOrDefault(cls.__primary_key__))
+                seq.append(args)
+            rows = yield from execute_many(cls.__insert__, seq)
+            if rows != len(batch):
+                logging.warn('failed to insert records: affected rows: %s of %s' % (rows, len(batch)))
+            yield from notify(batch, 'save')
+            results.append(rows)
+        return results
+
+    @classmethod
+    @asyncio.coroutine
+    def update_many(cls, models, batch_size=BATCH_SIZE):
+        ' update models by primary key in batches, return the affected rows of each batch. '
+        results = []
+        for i in range(0, len(models), batch_size):
+            batch = models[i:i+batch_size]
+            args = []
+            for m in batch:
+                args.append(m.getValue(cls.__primary_key__))
+                args.extend(map(m.getValue, cls.__fields__))
+            rows = yield from execute(cls._updateManySql(len(batch)), args)
+            yield from notify(batch, 'update')
+            results.append(rows)
+        return results
+
+    # 每批一条语句: 把各行的新值拼成一张派生表, 按主键join后一起更新
+    # update `blogs` t join (select ? as `id`, ? as `name` ... union all select ?, ? ...) v
+    #     on t.`id`=v.`id` set t.`name`=v.`name` ...
+    @classmethod
+    def _updateManySql(cls, n):
+        shape = ('update_many', cls.__table__, n)
+        sql = _shape_cache.get(shape)
+        if sql is None:
+            columns = [cls.__primary_key__] + [cls.__mappings__[f].name or f for f in cls.__fields__]
+            rows = ['select %s' % ', '.join('? as `%s`' % c for c in columns)]
+            rows.extend(['select %s' % create_args_string(len(columns))] * (n - 1))
+            sql = 'update `%s` t join (%s) v on t.`%s`=v.`%s` set %s' % (cls.__table__,
+                    ' union all '.join(rows), columns[0], columns[0],
+                    ', '.join('t.`%s`=v.`%s`' % (c, c) for c in columns[1:]))
+            if len(_shape_cache) >= SQL_CACHE_SIZE:
+                _shape_cache.clear()
+            _shape_cache[shape] = sql
+        return sql
+
     @asyncio.coroutine
     def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
@@ -249,6 +838,7 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = yield from execute(self.__insert__, args)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
+        yield from notify([self], 'save')
 
     @asyncio.coroutine
     def update(self):
@@ -257,10 +847,12 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = yield from execute(self.__update__, args)
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        yield from notify([self], 'update')
 
     @asyncio.coroutine
     def remove(self):
         args = [self.getValue(self.__primary_key__)]
         rows = yield from execute(self.__delete__, args)
         if rows != 1:
-            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
\ No newline at end of file
+            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+        yield from notify([self], 'remove')
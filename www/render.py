@@ -0,0 +1,288 @@
+# -*- coding:utf-8 -*-
+
+'''
+markdown rendering with a rendered-html cache
+
+缓存的key是 markdown2版本 + extras + 正文 的sha1, 正文不变就不用重新转换
+第一层是共享的缓存后端(见cache.py), 配置了render.cache_dir时再加一层磁盘缓存
+磁盘缓存的大小由render.cache_max_bytes(默认256M)和render.cache_max_age(秒, 默认不限)限制, 读写在线程池中进行
+
+请求处理中用markdown_async/blog_html_async, 转换放到进程池里执行, 不阻塞事件循环
+进程池建不起来时退回线程池; 排队的任务超过max_queue或者超过timeout秒没转换完时
+先返回转义后的原文, 转换结果出来后照样写入缓存
+'''
+
+import os
+import sys
+import html
+import json
+import asyncio
+import hashlib
+import logging
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import markdown2
+import orm
+from cache import Namespace, DiskCache, LRUCache
+from config import configs
+from models import Blog
+
+MARKDOWN_EXTRAS = []
+
+# markdown2版本或extras变化后, 已存的html_content需要重新渲染
+RENDER_VERSION = '%s-%s' % (markdown2.__version__,
+                            hashlib.sha1(json.dumps(MARKDOWN_EXTRAS, sort_keys=True).encode('utf-8')).hexdigest()[:8])
+
+_options = configs.get('render', {})
+
+_memory = Namespace('render')
+_disk = DiskCache(_options['cache_dir'], _options.get('cache_max_bytes', 256*1024*1024),
+                  _options.get('cache_max_age')) if _options.get('cache_dir') else None
+
+RENDER_WORKERS = _options.get('workers', 2)
+RENDER_QUEUE = _options.get('max_queue', 32)
+RENDER_TIMEOUT = _options.get('timeout', 5)
+# 超时过的正文在这么多秒内直接返回转义后的原文, 不再排队等待
+RENDER_BACKOFF = _options.get('backoff', 60)
+
+# 执行器在第一次使用时创建, server.py fork出的每个worker各有一个
+_executor = None
+_executor_pid = None
+_executor_stats = dict(kind=None, pending=0, submitted=0, timeouts=0, rejected=0, broken=0, shared=0, skipped=0)
+
+# cache_key => 正在转换的future, 同一篇正文同时只转换一次, 等待的请求共用结果
+_inflight = {}
+# 最近超时的cache_key, 每个按1计
+_timed_out = LRUCache(1024)
+
+def cache_key(text, extras=None):
+    if extras is None:
+        extras = MARKDOWN_EXTRAS
+    h = hashlib.sha1()
+    h.update(('%s:%s:' % (markdown2.__version__, json.dumps(extras, sort_keys=True))).encode('utf-8'))
+    h.update(text.encode('utf-8'))
+    return h.hexdigest()
+
+@asyncio.coroutine
+def markdown(text):
+    ' render in this process, using the caches. '
+    key = cache_key(text)
+    html = yield from _cached(key)
+    if html is not None:
+        return html
+    html = _convert(text)
+    yield from _store(key, html)
+    return html
+
+# 文件读写放到默认的线程池里, 不阻塞事件循环
+@asyncio.coroutine
+def _disk_call(func, *args):
+    return (yield from asyncio.get_event_loop().run_in_executor(None, func, *args))
+
+@asyncio.coroutine
+def _cached(key):
+    html = yield from _memory.get(key)
+    if html is None and _disk is not None:
+        html = yield from _disk_call(_disk.get, key)
+        if html is not None:
+            yield from _memory.set(key, html)
+    return html
+
+@asyncio.coroutine
+def _store(key, html):
+    yield from _memory.set(key, html)
+    if _disk is not None:
+        yield from _disk_call(_disk.set, key, html)
+
+# 在执行器中运行, 必须是模块级函数才能传给进程池
+def _convert(text):
+    return str(markdown2.converter_pool(extras=MARKDOWN_EXTRAS).convert(text))
+
+# 编辑页预览按块转换, 修改后只转换变化了的块; 存进缓存和html_content的仍用_convert整篇转换
+def _convert_blocks(text):
+    return str(markdown2.incremental_converter(extras=MARKDOWN_EXTRAS).convert(text))
+
+def plain(text):
+    lines = filter(lambda s: s.strip() != '', text.split('\n'))
+    return ''.join('<p>%s</p>' % html.escape(s) for s in lines)
+
+def executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        try:
+            _executor = ProcessPoolExecutor(RENDER_WORKERS)
+            _executor_stats['kind'] = 'process'
+        except (OSError, ImportError, NotImplementedError) as e:
+            logging.warning('process pool unavailable, rendering in threads: %s' % e)
+            _thread_executor()
+        _executor_pid = os.getpid()
+    return _executor
+
+def _thread_executor():
+    global _executor
+    _executor = ThreadPoolExecutor(RENDER_WORKERS)
+    _executor_stats['kind'] = 'thread'
+    return _executor
+
+# 子进程意外退出后整个进程池都不能再用, 丢掉它, 下次executor()重新创建
+# 只丢弃出错的那一个, 别的请求可能已经换上了新的
+def _reset_executor(broken):
+    global _executor
+    if _executor is broken:
+        _executor_stats['broken'] += 1
+        logging.warning('render process pool broken, restarting it')
+        _executor = None
+        broken.shutdown(wait=False)
+
+class RenderBusy(Exception):
+    pass
+
+# 这些情况下不等渲染结果, 调用方退回到转义后的原文或None
+_FAILURES = (RenderBusy, asyncio.TimeoutError, BrokenProcessPool)
+
+def _submit(key, text, convert=_convert):
+    f = _inflight.get(key) if key is not None else None
+    if f is not None:
+        _executor_stats['shared'] += 1
+        return f
+    if _executor_stats['pending'] >= RENDER_QUEUE:
+        _executor_stats['rejected'] += 1
+        raise RenderBusy()
+    ex = executor()
+    try:
+        f = ex.submit(convert, text)
+    except BrokenProcessPool:
+        _reset_executor(ex)
+        ex = executor()
+        f = ex.submit(convert, text)
+    _executor_stats['pending'] += 1
+    _executor_stats['submitted'] += 1
+
+    # 超时的任务仍在执行, 完成后才算出队, 结果也写入缓存
+    def done(f):
+        _executor_stats['pending'] -= 1
+        if _inflight.get(key) is f:
+            del _inflight[key]
+        if f.cancelled():
+            return
+        if isinstance(f.exception(), BrokenProcessPool):
+            _reset_executor(ex)
+        elif key is not None and f.exception() is None:
+            _timed_out.delete(key)
+            asyncio.ensure_future(_store(key, f.result()))
+    f = asyncio.wrap_future(f)
+    f.add_done_callback(done)
+    if key is not None:
+        _inflight[key] = f
+    return f
+
+@asyncio.coroutine
+def _render(text):
+    key = cache_key(text)
+    html = yield from _cached(key)
+    if html is not None:
+        return html
+    if _timed_out.get(key):
+        # 刚超时过: 还在转换或者已经失败了, 不再占着请求等一个timeout, 也不重新提交
+        _executor_stats['skipped'] += 1
+        raise asyncio.TimeoutError()
+    try:
+        return (yield from asyncio.wait_for(asyncio.shield(_submit(key, text)), RENDER_TIMEOUT))
+    except asyncio.TimeoutError:
+        _executor_stats['timeouts'] += 1
+        _timed_out.set(key, True, RENDER_BACKOFF, 1)
+        logging.warning('markdown rendering timed out (%s chars)' % len(text))
+        raise
+
+@asyncio.coroutine
+def preview(text):
+    ' render editor content; the document is not cached, its unchanged blocks are. '
+    try:
+        return (yield from asyncio.wait_for(asyncio.shield(_submit(None, text, _convert_blocks)), RENDER_TIMEOUT))
+    except _FAILURES:
+        return plain(text)
+
+@asyncio.coroutine
+def markdown_async(text, fallback=True):
+    ' render in the executor; when busy, too slow or the pool broke return escaped text, or None if not fallback. '
+    try:
+        return (yield from _render(text))
+    except _FAILURES:
+        return plain(text) if fallback else None
+
+@asyncio.coroutine
+def blog_html_async(blog, fallback=True):
+    if blog.get('render_version') == RENDER_VERSION and blog.get('html_content') is not None:
+        return blog.html_content
+    # blog id => 这次渲染用的key, 存在共享后端里, 任何一个worker写这篇blog时都能据此删除缓存
+    yield from _memory.set(_id_key(blog.id), cache_key(blog.content))
+    return (yield from markdown_async(blog.content, fallback))
+
+@asyncio.coroutine
+def prerender(blog):
+    ' store rendered html on the blog, called before save/update. '
+    blog.html_content = yield from markdown(blog.content)
+    blog.render_version = RENDER_VERSION
+    return blog
+
+@asyncio.coroutine
+def prerender_async(blog):
+    ' like prerender, but in the executor; the html is left empty if rendering fails. '
+    try:
+        blog.html_content = yield from _render(blog.content)
+        blog.render_version = RENDER_VERSION
+    except _FAILURES:
+        blog.html_content = None
+        blog.render_version = None
+    return blog
+
+async def backfill(batch=100):
+    ' re-render every blog whose html was rendered by another version. '
+    n = 0
+    blogs = []
+    async for blog in Blog.iterate('`render_version` is null or `render_version`<>?', [RENDER_VERSION], batch=batch):
+        blogs.append(await prerender(blog))
+        if len(blogs) >= batch:
+            await Blog.update_many(blogs)
+            n = n + len(blogs)
+            blogs = []
+            logging.info('backfill: %s blogs re-rendered' % n)
+    if blogs:
+        await Blog.update_many(blogs)
+        n = n + len(blogs)
+    return n
+
+def _id_key(blog_id):
+    return 'id:%s' % blog_id
+
+@asyncio.coroutine
+def invalidate(blog_id):
+    key = yield from _memory.get(_id_key(blog_id))
+    if key is None:
+        return
+    yield from _memory.delete(_id_key(blog_id))
+    yield from _memory.delete(key)
+    if _disk is not None:
+        yield from _disk_call(_disk.delete, key)
+
+def stats():
+    return dict(_memory.stats(), executor=dict(_executor_stats))
+
+@orm.add_listener
+@asyncio.coroutine
+def _on_write(models, action):
+    if isinstance(models[0], Blog):
+        for blog_id in set(m.id for m in models):
+            yield from invalidate(blog_id)
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['backfill']:
+        print('Usage: python3 render.py backfill')
+        exit(0)
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(orm.create_pool(loop=loop, user=configs.db.user, pwd=configs.db.password, db=configs.db.db))
+    n = loop.run_until_complete(backfill())
+    print('%s blogs re-rendered with %s' % (n, RENDER_VERSION))
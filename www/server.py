@@ -0,0 +1,310 @@
+# -*- coding:utf-8 -*-
+
+'''
+production launcher
+
+    python3 server.py [workers]     启动主进程和workers个worker, 默认为CPU核数
+    python3 server.py status        查看各worker最近一次上报的健康状况
+
+主进程只负责绑定端口, fork worker和监控, 不导入app/orm
+每个worker有自己的事件循环和数据库连接池, 所以平滑重启时新worker会加载磁盘上最新的代码
+多个worker时缓存后端必须是共享的(mmap或redis): memory后端每个进程各一份, 写操作只能让本进程的页面和查询缓存失效
+configs.server.reuse_port为True时每个worker用SO_REUSEPORT各自绑定端口, 由内核分配连接
+否则主进程预先绑定好socket, 所有worker在同一个socket上accept
+
+信号:
+    HUP         平滑重启: 先启动新的一组worker, 新worker都就绪后让旧的处理完手上的请求再退出
+    TERM, INT   所有worker处理完手上的请求后退出
+'''
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import logging
+import selectors
+
+from config import configs
+
+# worker每HEALTH_INTERVAL秒上报一次, 超过HEALTH_TIMEOUT秒没有上报(事件循环被卡住)就杀掉重启
+HEALTH_INTERVAL = 5
+HEALTH_TIMEOUT = 30
+# 停止时等待正在处理的请求完成的时间
+GRACEFUL_TIMEOUT = 30
+# worker启动后很快就退出(代码或配置有错)时, 等这么多秒再重新启动, 避免不停地fork
+RESPAWN_DELAY = 1
+BACKLOG = 128
+
+_options = configs.get('server', {})
+
+def bind_socket(host, port, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+def run_worker(sock, fd):
+    ' worker process body, never returns. '
+    import asyncio
+    import app
+    import orm
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.set_blocking(fd, False)
+    if sock is None:
+        sock = bind_socket(_options.get('host', '127.0.0.1'), _options.get('port', 9000), True)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    application = loop.run_until_complete(app.make_app(loop))
+    handler = application.make_handler()
+    srv = loop.run_until_complete(loop.create_server(handler, sock=sock))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+    @asyncio.coroutine
+    def report():
+        while True:
+            db = orm.stats()
+            health = dict(pid=os.getpid(), at=time.time(),
+                          uptime=time.time() - app.request_stats['started_at'],
+                          requests=app.request_stats['requests'],
+                          connections=len(getattr(handler, 'connections', ())),
+                          pool=db['pool'], slow_queries=len(db['slow_queries']))
+            try:
+                os.write(fd, (json.dumps(health) + '\n').encode('utf-8'))
+            except BlockingIOError:
+                # 主进程没来得及读, 丢掉这一次
+                pass
+            yield from asyncio.sleep(HEALTH_INTERVAL)
+
+    reporter = loop.create_task(report())
+    logging.info('worker %s serving...' % os.getpid())
+    loop.run_forever()
+    # 收到TERM: 不再accept, 等正在处理的请求完成
+    logging.info('worker %s stopping...' % os.getpid())
+    reporter.cancel()
+    srv.close()
+    loop.run_until_complete(srv.wait_closed())
+    loop.run_until_complete(application.shutdown())
+    loop.run_until_complete(handler.shutdown(GRACEFUL_TIMEOUT))
+    loop.run_until_complete(application.cleanup())
+    loop.run_until_complete(orm.close_pool())
+    loop.close()
+    os._exit(0)
+
+class Worker(object):
+    def __init__(self, pid, fd, generation):
+        self.pid = pid
+        self.fd = fd
+        self.generation = generation
+        self.started_at = time.time()
+        self.last_seen = self.started_at
+        self.health = None
+        self.stopping_at = None
+        self._buf = b''
+
+    def feed(self, data):
+        self._buf = self._buf + data
+        lines = self._buf.split(b'\n')
+        self._buf = lines.pop()
+        for line in lines:
+            self.health = json.loads(line.decode('utf-8'))
+            self.last_seen = time.time()
+
+    def status(self):
+        return dict(pid=self.pid, generation=self.generation, started_at=self.started_at,
+                    last_seen=self.last_seen, stopping=self.stopping_at is not None, health=self.health)
+
+class Master(object):
+    def __init__(self, workers, host, port, reuse_port=False, status_file=None):
+        self.size = workers
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.status_file = status_file
+        self.sock = None
+        self.workers = {}
+        self.generation = 0
+        self.stopping = False
+        self._signals = []
+        self._respawn_at = 0
+        self._selector = selectors.DefaultSelector()
+
+    def spawn(self):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            self._selector.close()
+            for other in self.workers.values():
+                os.close(other.fd)
+            try:
+                run_worker(self.sock, w)
+            except Exception as e:
+                logging.exception(e)
+            os._exit(1)
+        os.close(w)
+        os.set_blocking(r, False)
+        worker = self.workers[pid] = Worker(pid, r, self.generation)
+        self._selector.register(r, selectors.EVENT_READ, worker)
+        logging.info('worker %s started (generation %s)' % (pid, self.generation))
+
+    def kill(self, worker, sig=signal.SIGTERM):
+        if worker.stopping_at is None:
+            worker.stopping_at = time.time()
+        try:
+            os.kill(worker.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def restart(self):
+        ' start a new generation; the old one is stopped once the new workers report in. '
+        logging.info('graceful restart...')
+        self.generation += 1
+        for i in range(self.size):
+            self.spawn()
+
+    def stop(self):
+        logging.info('stopping %s workers...' % len(self.workers))
+        self.stopping = True
+        for w in list(self.workers.values()):
+            self.kill(w)
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def _handle_signals(self):
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum == signal.SIGHUP and not self.stopping:
+                self.restart()
+            elif signum in (signal.SIGTERM, signal.SIGINT):
+                self.stop()
+
+    def _read(self, timeout):
+        for key, mask in self._selector.select(timeout):
+            worker = key.data
+            try:
+                data = os.read(worker.fd, 65536)
+            except BlockingIOError:
+                continue
+            if data:
+                try:
+                    worker.feed(data)
+                except ValueError:
+                    logging.warning('worker %s: bad health report' % worker.pid)
+            else:
+                self._selector.unregister(worker.fd)
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.fd in self._selector.get_map():
+                self._selector.unregister(worker.fd)
+            os.close(worker.fd)
+            if worker.stopping_at is None:
+                logging.warning('worker %s exited unexpectedly (status %s)' % (pid, status))
+                if time.time() - worker.started_at < RESPAWN_DELAY:
+                    self._respawn_at = time.time() + RESPAWN_DELAY
+            else:
+                logging.info('worker %s stopped' % pid)
+
+    def _check(self):
+        now = time.time()
+        current = [w for w in self.workers.values() if w.generation == self.generation and w.stopping_at is None]
+        for w in current:
+            if now - w.last_seen > HEALTH_TIMEOUT:
+                logging.warning('worker %s unresponsive for %.0fs, killing' % (w.pid, now - w.last_seen))
+                self.kill(w, signal.SIGKILL)
+        for w in self.workers.values():
+            if w.stopping_at is not None and now - w.stopping_at > GRACEFUL_TIMEOUT + HEALTH_INTERVAL:
+                self.kill(w, signal.SIGKILL)
+        if self.stopping or now < self._respawn_at:
+            return
+        # 新一代的worker都上报过之后再停掉旧的
+        if len(current) >= self.size and all(w.health is not None for w in current):
+            for w in self.workers.values():
+                if w.generation != self.generation and w.stopping_at is None:
+                    self.kill(w)
+        for i in range(self.size - len(current)):
+            self.spawn()
+
+    def _write_status(self):
+        if not self.status_file:
+            return
+        status = dict(pid=os.getpid(), generation=self.generation, at=time.time(),
+                      workers=[w.status() for w in self.workers.values()])
+        tmp = '%s.%s' % (self.status_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp, self.status_file)
+
+    def run(self):
+        if not self.reuse_port:
+            self.sock = bind_socket(self.host, self.port)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+        logging.info('master %s listening on %s:%s' % (os.getpid(), self.host, self.port))
+        for i in range(self.size):
+            self.spawn()
+        while self.workers or not self.stopping:
+            self._read(1)
+            self._handle_signals()
+            self._reap()
+            self._check()
+            self._write_status()
+        if self.sock is not None:
+            self.sock.close()
+        if self.status_file and os.path.exists(self.status_file):
+            os.remove(self.status_file)
+        logging.info('master stopped')
+
+def status(path):
+    try:
+        with open(path) as f:
+            s = json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        print('not running')
+        return
+    print('master %s, generation %s' % (s['pid'], s['generation']))
+    for w in s['workers']:
+        h = w['health'] or {}
+        print('  worker %-7s gen %-3s %-8s last seen %4.0fs ago, %s requests, %s connections' % (
+            w['pid'], w['generation'], 'stopping' if w['stopping'] else 'running',
+            s['at'] - w['last_seen'], h.get('requests', '-'), h.get('connections', '-')))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    argv = sys.argv[1:]
+    status_file = _options.get('status_file', '/tmp/blog-server.json')
+    if argv and argv[0] == 'status':
+        status(status_file)
+        exit(0)
+    if argv and not argv[0].isdigit():
+        print(__doc__)
+        exit(0)
+    workers = int(argv[0]) if argv else _options.get('workers', os.cpu_count() or 1)
+    if workers > 1 and configs.get('cache', {}).get('backend', 'memory') == 'memory':
+        logging.error('cache backend "memory" is not shared between workers, '
+                      'set configs.cache.backend to mmap (with a path) or redis, or run a single worker')
+        exit(1)
+    master = Master(workers, _options.get('host', '127.0.0.1'), _options.get('port', 9000),
+                    _options.get('reuse_port', False), status_file)
+    master.run()
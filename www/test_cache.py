@@ -0,0 +1,188 @@
+# -*- coding:utf-8 -*-
+
+'''
+cache.py的三种后端: get/set/delete/counter/incr的行为必须一致
+
+    python3 test_cache.py
+也可以用pytest运行; redis用的是cache.LocalRedisServer, 不需要真的redis
+'''
+
+import os
+import time
+import shutil
+import socket
+import asyncio
+import tempfile
+import threading
+
+import cache
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        # redis连接的读任务还在等回复, 取消后它会关掉连接
+        tasks = asyncio.all_tasks(loop)
+        for t in tasks:
+            t.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+        asyncio.set_event_loop(None)
+
+def _redis_server():
+    server = cache.LocalRedisServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def _stop(server):
+    server.shutdown()
+    server.server_close()
+
+class _Backends(object):
+    ' memory, mmap and redis backends on a temporary directory and a local redis server. '
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = _redis_server()
+        return [cache.MemoryBackend(),
+                cache.MmapBackend(os.path.join(self.dir, 'cache.mmap'), slots=64, slot_size=256, max_span=8),
+                cache.RedisBackend('127.0.0.1', self.server.server_address[1], db=1)]
+
+    def __exit__(self, *args):
+        _stop(self.server)
+        shutil.rmtree(self.dir)
+
+@asyncio.coroutine
+def _check_values(b):
+    assert (yield from b.get('missing')) is None
+    for value in ['text', 'x' * 1000, 42, 1.5, True, [1, 'a'], {'a': {'b': [1, 2]}}, b'\x00\xff', (1, 'a')]:
+        yield from b.set('k', value)
+        assert (yield from b.get('k')) == value, (b, value)
+    yield from b.set('k', {'id': '001', 'tags': ('a', b'b')})
+    assert (yield from b.get('k')) == {'id': '001', 'tags': ('a', b'b')}
+    yield from b.delete('k')
+    assert (yield from b.get('k')) is None
+    yield from b.delete('k')
+    yield from b.set('t', 'soon gone', ttl=0.2)
+    assert (yield from b.get('t')) == 'soon gone'
+    yield from asyncio.sleep(0.3)
+    assert (yield from b.get('t')) is None
+
+@asyncio.coroutine
+def _check_counters(b):
+    n = yield from b.counter('v')
+    assert isinstance(n, int)
+    assert (yield from b.counter('v')) == n
+    assert (yield from b.incr('v')) == n + 1
+    assert (yield from b.incr('v')) == n + 2
+    assert (yield from b.counter('v')) == n + 2
+    # 没读过的计数器也能直接递增
+    m = yield from b.incr('w')
+    assert (yield from b.counter('w')) == m
+    # 删除后重新开始, 起始值比之前的都大, 旧版本号的缓存不会再命中
+    yield from b.delete('v')
+    assert (yield from b.counter('v')) > n + 2
+
+def test_backends():
+    with _Backends() as backends:
+        for b in backends:
+            _run(_check_values(b))
+            _run(_check_counters(b))
+        assert backends[1].stats()['too_large'] == 0
+
+def test_mmap_spans():
+    d = tempfile.mkdtemp()
+    try:
+        b = cache.MmapBackend(os.path.join(d, 'cache.mmap'), slots=64, slot_size=256, max_span=8)
+        @asyncio.coroutine
+        def check():
+            big = 'x' * 1500
+            yield from b.set('a', big)
+            assert (yield from b.get('a')) == big
+            yield from b.set('a', 'small')
+            assert (yield from b.get('a')) == 'small'
+            # 超过max_span个slot的存不下, 当作没有
+            yield from b.set('b', 'y' * 5000)
+            assert (yield from b.get('b')) is None
+            assert b.stats()['too_large'] == 1
+            # 后面的一段被别的key覆盖了, 整个条目就失效
+            yield from b.set('a', big)
+            k, h, offset = b._slot('a')
+            other = next(key for key in ('k%d' % i for i in range(10000))
+                         if b._slot(key)[2] == b._offset(offset, 2))
+            yield from b.set(other, 'z')
+            assert (yield from b.get(other)) == 'z'
+            assert (yield from b.get('a')) is None
+            # 另一个进程打开同一个文件也能读到
+            again = cache.MmapBackend(b.path, slots=64, slot_size=256, max_span=8)
+            assert (yield from again.get(other)) == 'z'
+        _run(check())
+        assert os.stat(b.path).st_mode & 0o777 == 0o600
+    finally:
+        shutil.rmtree(d)
+
+def test_counter_expiry():
+    ttl = cache.COUNTER_TTL
+    cache.COUNTER_TTL = 1
+    try:
+        with _Backends() as backends:
+            for b in backends:
+                @asyncio.coroutine
+                def check():
+                    n = yield from b.counter('v')
+                    yield from b.incr('v')
+                    yield from asyncio.sleep(1.2)
+                    assert (yield from b.counter('v')) > n + 1, b
+                _run(check())
+    finally:
+        cache.COUNTER_TTL = ttl
+
+def test_redis_down():
+    # 先占一个端口再关掉, 这个端口上没有服务
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    b = cache.RedisBackend('127.0.0.1', port, timeout=0.5)
+    saved = cache._backend
+    cache._backend = b
+    try:
+        @asyncio.coroutine
+        def check():
+            t = time.time()
+            assert (yield from b.get('k')) is None
+            yield from b.set('k', 'v')
+            yield from b.delete('k')
+            assert (yield from b.counter('v')) is None
+            assert (yield from b.incr('v')) is None
+            # 版本号拿不到时调用方不读也不写缓存
+            assert (yield from cache.Namespace('test').version('x')) is None
+            assert time.time() - t < 3
+        _run(check())
+    finally:
+        cache._backend = saved
+
+def test_redis_flushed():
+    # redis重启后数据没了: 计数器从新的起始值开始, 比丢掉的版本号都大
+    server = _redis_server()
+    b = cache.RedisBackend('127.0.0.1', server.server_address[1])
+    @asyncio.coroutine
+    def check():
+        n = yield from b.incr('v')
+        yield from b.set('k', 'v')
+        server.data.clear()
+        assert (yield from b.get('k')) is None
+        assert (yield from b.counter('v')) > n
+    try:
+        _run(check())
+    finally:
+        _stop(server)
+
+if __name__ == '__main__':
+    test_backends()
+    test_mmap_spans()
+    test_counter_expiry()
+    test_redis_down()
+    test_redis_flushed()
+    print('ok')
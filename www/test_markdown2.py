@@ -0,0 +1,95 @@
+# -*- coding:utf-8 -*-
+
+'''
+IncrementalMarkdown和Markdown.convert的输出必须逐字节相同
+
+    python3 test_markdown2.py [docs]     随机生成docs篇文档对比, 默认2000
+也可以用pytest运行
+'''
+
+import re
+import sys
+import random
+
+import markdown2
+
+CONFIGS = [
+    dict(),
+    dict(extras=['fenced-code-blocks', 'tables', 'smarty-pants', 'cuddled-lists']),
+    dict(safe_mode='escape', extras=['fenced-code-blocks']),
+]
+
+# 这些曾经转换得不一样
+CASES = [
+    '## Steps\n1. Install\n\n2. Configure\n\n3. Run',
+    '## Notes\n> first\n\n> second',
+    'para\n\n- a\n\n- b\n\n  more\n\n1. x\n\n2. y\n\n> q1\n\n> q2\n\ntext [a] and [b][]\n\n[a]: http://a "T"\n[b]: <http://b>\n\n    code\n\n    more code\n\nend\n',
+    '-----\n1. first\nlazy\n\n  \n\n　\n+ plus item\n\n　\n\n  - sub item\n\n',
+    '```\n\n>\n\n*\n-\nx = 1\n2. second\n```python\n\n> > nested\n```\n-----\n1. first\npara text',
+    '```js\nx = 1\n[a]: http://a.example/ "T"\n\n  \n\n```python\n\n\n# Header\n',
+    '```\na\n```\n```\nb\n\nc\n```\n',
+    '* star item\n\n  two-space\n\n\n  \n  - sub item\n\n    1. sub ordered\n    1. sub ordered\n\n\n```  \na [link][a] here\n\n*\n  two-space\n\n1. first',
+    'Title\n=====\n\nSub\n---\n\n* * *\n\n```\nx\n\n\ny\n```\n\nafter\n',
+    '- \n\npara',
+    'text\n\n1. \n\n> quote\n\n- a\n- \n\n\npara\n\n*\t\n\n## Steps',
+]
+
+LINES = [
+    'para text', 'more *emph* text', 'a [link][a] here', 'see [b]', '`code` span', '***bold***',
+    '- item', '- ', '1. ', '* ', '-  ', '10.\t', '* star item', '+ plus item', '1. first', '2. second', '10. tenth', '- [ ] task',
+    '> quote', '> > nested', '>', '>lazy', '> - quoted item', '> ```', '  > indented quote',
+    '    indented code', '  two-space', '\tTabbed', '  - sub item', '    1. sub ordered', '   - three',
+    '# Header', '## Steps', 'Title', '=====', '-----', '* * *', '- - -', '-', '1.', '*',
+    '```', '```python', '```js', '```  ', '  ```', '    ```', 'x = 1',
+    '[a]: http://a.example/ "T"', '[b]: <http://b.example/>', '![img][a]',
+    '| a | b |', '|---|---|', 'lazy continuation', 'trailing  ', '\\* escaped', '&amp; & <',
+    '　', '  ', '\t', 'text with <b>tag</b>', 'http://auto.example/', '<http://auto.example/>',
+]
+
+# 转换中途泄漏出来的占位符每次都不一样, 不算差异; 代码高亮会把占位符拆进几个<span>
+_PLACEHOLDER = re.compile(r'md5(?:<[^>]*>)*-(?:(?:<[^>]*>)*[0-9a-f])+')
+
+def _doc(rnd):
+    lines = []
+    for i in range(rnd.randint(1, 24)):
+        lines.append(rnd.choice(LINES))
+        r = rnd.random()
+        if r < 0.35:
+            lines.append('')
+        elif r < 0.45:
+            lines.extend(['', ''])
+    return '\n'.join(lines)
+
+def check(text, config):
+    ' return (expected, got) if the outputs differ, else None. '
+    expected = markdown2.Markdown(**config).convert(text)
+    got = markdown2.IncrementalMarkdown(**config).convert(text)
+    if _PLACEHOLDER.sub('', expected) != _PLACEHOLDER.sub('', got):
+        return expected, got
+    return None
+
+def test_cases():
+    for text in CASES:
+        for config in CONFIGS:
+            assert check(text, config) is None, (text, config)
+
+def test_random(docs=2000, seed=0):
+    rnd = random.Random(seed)
+    for i in range(docs):
+        text = _doc(rnd)
+        for config in CONFIGS:
+            assert check(text, config) is None, (text, config)
+
+def test_reuse():
+    # 同一个转换器反复转换(块缓存命中)结果也一样
+    md = markdown2.IncrementalMarkdown()
+    rnd = random.Random(1)
+    texts = [_doc(rnd) for i in range(200)]
+    for text in texts + texts:
+        assert _PLACEHOLDER.sub('', md.convert(text)) == _PLACEHOLDER.sub('', markdown2.markdown(text)), text
+
+if __name__ == '__main__':
+    test_cases()
+    test_reuse()
+    test_random(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
+    print('ok')